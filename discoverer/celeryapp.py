@@ -5,11 +5,12 @@ from functools import wraps
 
 import os
 from celery import Celery
+from celery.signals import worker_ready, worker_shutdown
 # set the default Django settings module for the 'celery' program.
 from django.core.cache import cache
 from django.utils import timezone
 
-from discoverer.utils import acquire_lock
+from discoverer.utils import acquire_lock, publish_worker_presence, clear_worker_presence
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'discoverer.settings')
 
@@ -42,6 +43,7 @@ def close_worker_if_no_tasks_scheduled(worker_hostname):
 LAST_TASK_KEY = 'celeryapp:discoverer:last_task_timestamp'
 HEARTBEAT_LOCK_KEY = 'heartbeat_lock'
 HEARTBEAT_PERIOD_MINUTES = 5
+HEARTBEAT_LOCK_TTL = HEARTBEAT_PERIOD_MINUTES*2*60
 
 
 def heartbeat_idle_timeout(f):
@@ -51,12 +53,24 @@ def heartbeat_idle_timeout(f):
     def wrapper(*args, **kwargs):
         ret = f(*args, **kwargs)
         cache.set(LAST_TASK_KEY, timezone.now())
-        if acquire_lock(HEARTBEAT_LOCK_KEY):
+        publish_worker_presence()
+        # expires on its own if the heartbeat check chain dies with its worker
+        if acquire_lock(HEARTBEAT_LOCK_KEY, ttl=HEARTBEAT_LOCK_TTL):
             heartbeat_idle_check.apply_async(eta=timezone.now() + datetime.timedelta(minutes=HEARTBEAT_PERIOD_MINUTES))
         return ret
     return wrapper
 
 
+@worker_ready.connect
+def announce_worker_presence(sender=None, **kwargs):
+    publish_worker_presence(hostname=getattr(sender, 'hostname', None))
+
+
+@worker_shutdown.connect
+def withdraw_worker_presence(sender=None, **kwargs):
+    clear_worker_presence()
+
+
 def get_last_task_time():
     last = cache.get(LAST_TASK_KEY)
     if last is None:
@@ -0,0 +1,96 @@
+import json
+import uuid
+from collections import OrderedDict
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+INGEST_QUEUE_KEY = 'discoverer:ingest:queue'
+# payloads being written, they only leave it once the write is done
+INGEST_PROCESSING_KEY = 'discoverer:ingest:processing'
+
+_redis = None
+
+
+def redis_connection():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.CELERY_BROKER_URL)
+    return _redis
+
+
+def ingest_async_enabled():
+    return getattr(settings, 'PORTAL_INGEST_ASYNC', False)
+
+
+def enqueue_submission(user, items):
+    """
+    Add a validated /spi payload to the ingestion queue and return its ticket id.
+    """
+    ticket = uuid.uuid4().hex
+    redis_connection().lpush(INGEST_QUEUE_KEY, json.dumps({
+        'ticket': ticket,
+        'user_id': user.pk,
+        'items': items,
+        'submitted_at': timezone.now().isoformat(),
+    }))
+    return ticket
+
+
+def claim_submissions(max_submissions):
+    """
+    Move up to ``max_submissions`` of the oldest queued payloads to the processing list and return them.
+    They stay there until ``ack_submissions``, so a drain that dies half way loses nothing.
+    """
+    pipe = redis_connection().pipeline(transaction=True)
+    for i in range(max_submissions):
+        pipe.rpoplpush(INGEST_QUEUE_KEY, INGEST_PROCESSING_KEY)
+    return [payload for payload in pipe.execute() if payload is not None]
+
+
+def ack_submissions(payloads):
+    """
+    Drop claimed payloads from the processing list once they are written.
+    """
+    pipe = redis_connection().pipeline(transaction=False)
+    for payload in payloads:
+        pipe.lrem(INGEST_PROCESSING_KEY, 1, payload)
+    pipe.execute()
+
+
+def requeue_unacked_submissions():
+    """
+    Put payloads left in the processing list by a drain that didn't finish back on the queue.
+    Only safe while no other drain is running.
+    """
+    connection = redis_connection()
+    requeued = 0
+    while connection.rpoplpush(INGEST_PROCESSING_KEY, INGEST_QUEUE_KEY) is not None:
+        requeued += 1
+    return requeued
+
+
+def queued_submission_count():
+    return redis_connection().llen(INGEST_QUEUE_KEY)
+
+
+def merge_submissions(payloads):
+    """
+    Collapse queued payloads into a list of (user_id, submitted_at, item),
+    keeping the latest submission of each guid.
+    """
+    submissions = [json.loads(payload) for payload in payloads]
+    for submission in submissions:
+        submission['submitted_at'] = parse_datetime(submission['submitted_at'])
+    # requeued payloads come back behind newer ones
+    submissions.sort(key=lambda submission: submission['submitted_at'])
+    merged = OrderedDict()
+    for submission in submissions:
+        submitted_at = submission['submitted_at']
+        for item in submission['items']:
+            key = item.get('guid') or (item['latE6'], item['lngE6'])
+            merged.pop(key, None)
+            merged[key] = (submission['user_id'], submitted_at, item)
+    return list(merged.values())
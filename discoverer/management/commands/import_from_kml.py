@@ -1,78 +1,196 @@
+import Queue
 import datetime
+import multiprocessing
 import os
+import threading
+import time
 
-from django.core.management.base import LabelCommand
-from pykml import parser
+from django.core.management.base import LabelCommand, CommandError
+from lxml import etree
 from pymongo.errors import BulkWriteError
 
-from discoverer.portalindex.helpers import MongoHelper, PortalIndexHelper
+from discoverer.models import SearchRegion
+from discoverer.portalindex.bulk import DUPLICATE_KEY_ERROR
+from discoverer.portalindex.helpers import MongoHelper, MongoPortalIndex, portal_refs, KML_NAMESPACE
 
 
-_filter_bounds = [
-    [46887566, -125208619],
-    [40258825, -115094343],
-]
+def _kml(tag):
+    return '{{{}}}{}'.format(KML_NAMESPACE, tag)
+
 
 class Command(LabelCommand):
-    def handle_label(self, label, **options):
-        with open(label, 'r') as kmlfile:
-            doc = parser.parse(kmlfile)
+    """
+    Streams placemarks out of the kml with iterparse, so memory stays flat however large the file is.
+    The main thread parses, drops the placemarks outside the search regions and hands chunks through
+    a bounded queue to writer threads, which hash their _refs on the process pool and insert them.
+    """
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), dest='processes',
+                            help="processes hashing _refs, 1 hashes on the writer threads")
+        parser.add_argument('--writers', type=int, default=2, dest='writers')
+        parser.add_argument('--chunk-size', type=int, default=5000, dest='chunk_size')
+        parser.add_argument('--queue-size', type=int, default=4, dest='queue_size',
+                            help="chunks parsed ahead of the writers")
+        parser.add_argument('--region', action='append', dest='regions',
+                            help="only import placemarks in the search region of this name, defaults to the active ones")
+        parser.add_argument('--all', action='store_true', dest='all',
+                            help="import placemarks wherever they are")
+
+    def handle(self, *labels, **options):
+        self.processes = options.get('processes')
+        if self.processes < 1:
+            raise CommandError("--processes must be at least 1")
+        if options.get('writers') < 1:
+            raise CommandError("--writers must be at least 1")
+        if options.get('chunk_size') < 1 or options.get('queue_size') < 1:
+            raise CommandError("--chunk-size and --queue-size must be at least 1")
+        self.regions = None
+        if not options.get('all'):
+            self.regions = SearchRegion.objects.region_index(names=options.get('regions'))
+            if not self.regions:
+                raise CommandError("no search regions to import into, pass --region or --all")
+        self.pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+        try:
+            return super(Command, self).handle(*labels, **options)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+
+    def placemarks(self, kmlfile):
+        """
+        Yields (name, latE6, lngE6) of each placemark, or None for placemarks without coordinates.
+        """
+        for event, elem in etree.iterparse(kmlfile, events=('end',), tag=_kml('Placemark')):
+            values = [data.text for data in elem.iterfind('{}/{}/{}'.format(
+                _kml('ExtendedData'), _kml('SchemaData'), _kml('SimpleData')))]
+            name = elem.findtext(_kml('name'))
+            if len(values) < 2 or name is None:
+                yield None
+            else:
+                yield name, int(round(float(values[0])*1e6)), int(round(float(values[1])*1e6))
+            # drop what has been read so the tree never grows
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+    def in_regions(self, chunk):
+        """
+        The placemarks of ``chunk`` inside the search regions. Only called from the parser thread,
+        GEOS prepared geometries can't be shared between threads.
+        """
+        if self.regions is None:
+            return chunk
+        in_regions = self.regions.point_in_regions(doc['location']['coordinates'] for doc in chunk)
+        return [doc for doc, region in zip(chunk, in_regions) if region is not None]
+
+    def insert_chunk(self, collection, chunk, counts):
+        # spread each chunk over every pool process
+        chunk_size = max(1000, len(chunk) // self.processes)
+        refs = portal_refs([doc['_latE6'] for doc in chunk], [doc['_lngE6'] for doc in chunk],
+                           [doc['name'] for doc in chunk], pool=self.pool, chunk_size=chunk_size)
+        for doc, ref in zip(chunk, refs):
+            del doc['_latE6'], doc['_lngE6']
+            doc['_ref'] = ref
+            doc['_history'] = [doc.copy()]
+            doc['discovered_at'] = doc['timestamp']
+            doc['discovered_by'] = doc['reporter']
+        try:
+            result = collection.insert_many(chunk, ordered=False)
+            counts['inserted'] += len(result.inserted_ids)
+        except BulkWriteError as e:
+            counts['inserted'] += e.details.get('nInserted', 0)
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == DUPLICATE_KEY_ERROR:
+                    counts['duplicates'] += 1
+                else:
+                    counts['errors'] += 1
+
+    def writer(self, chunks, collection, counts, failures):
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if failures:
+                # keep draining so the parser never blocks on a full queue
+                continue
+            try:
+                self.insert_chunk(collection, chunk, counts)
+            except Exception as e:
+                failures.append(e)
 
+    def handle_label(self, label, **options):
         discover_date = datetime.datetime(year=2016, month=7, day=16)
         reporter = os.path.basename(label)
+        chunk_size = options.get('chunk_size')
+        started = time.time()
 
         mongo = MongoHelper()
         collection = mongo.db.portals
 
-        ns = {'kml': 'http://www.opengis.net/kml/2.2'}
-        placemarks = doc.findall('kml:Document/kml:Folder/kml:Placemark', ns)
+        chunks = Queue.Queue(maxsize=options.get('queue_size'))
+        failures = []
+        writer_counts = []
+        writers = []
+        for i in range(options.get('writers')):
+            counts = {'inserted': 0, 'duplicates': 0, 'errors': 0}
+            writer_counts.append(counts)
+            writers.append(threading.Thread(target=self.writer, args=(chunks, collection, counts, failures)))
+        for writer in writers:
+            writer.daemon = True
+            writer.start()
 
-        max_chunk_size = 1000
+        parsed = 0
+        malformed = 0
+        out_of_bounds = 0
         chunk = []
-        inserted = 0
-        for p in placemarks:
-            ll = p.findall('kml:ExtendedData/kml:SchemaData/kml:SimpleData', ns)
-            if len(ll) < 2:
-                print("wha?", p.name, ll)
-                continue
-            latE6 = int(float(ll[0])*1e6)
-            lngE6 = int(float(ll[1])*1e6)
-            if not(latE6 <= _filter_bounds[0][0] and latE6 >= _filter_bounds[1][0] and
-                   lngE6 >= _filter_bounds[0][1] and lngE6 <= _filter_bounds[1][1]):
-                # print("skipping, out of bounds {},{}".format(latE6, lngE6))
-                continue
-            # else:
-            #     print("In bounds!")
-
-            doc = {
-                'location': {
-                    "type": "Point",
-                    "coordinates": [lngE6/1e6, latE6/1e6]
-                },
-                'name': unicode(p.name),
-                'timestamp': discover_date,
-                'reporter': reporter,
-            }
-            doc['_ref'] = PortalIndexHelper.sha_hash(doc)
-            doc['_history'] = [doc.copy()]
-            chunk.append(doc)
-            cur_chunk_size = len(chunk)
-            if cur_chunk_size >= max_chunk_size:
-                print("insert_many={}".format(cur_chunk_size))
-
-                try:
-                    result = collection.insert_many(chunk, ordered=False)
-                    inserted += len(result.inserted_ids)
-                except BulkWriteError as e:
-                    pass # latlng duplicates
-                    # print(e.details)
-                    # raise
-                chunk = []
-        if len(chunk) > 0:
-            try:
-                result = collection.insert_many(chunk, ordered=False)
-                inserted += len(result.inserted_ids)
-            except BulkWriteError as e:
-                pass # latlng duplicates
-        print("Done. inserted {}".format(inserted))
 
+        def put(chunk):
+            kept = self.in_regions(chunk)
+            if kept:
+                chunks.put(kept)
+            return len(chunk) - len(kept)
+
+        with open(label, 'rb') as kmlfile:
+            for placemark in self.placemarks(kmlfile):
+                parsed += 1
+                if placemark is None:
+                    malformed += 1
+                    continue
+                name, latE6, lngE6 = placemark
+                chunk.append({
+                    'location': {
+                        "type": "Point",
+                        "coordinates": [lngE6/1e6, latE6/1e6]
+                    },
+                    'name': unicode(name),
+                    'timestamp': discover_date,
+                    'reporter': reporter,
+                    '_latE6': latE6,
+                    '_lngE6': lngE6,
+                })
+                if len(chunk) >= chunk_size:
+                    out_of_bounds += put(chunk)
+                    chunk = []
+                if parsed % (chunk_size * 20) == 0:
+                    self.stdout.write("parsed {} ({:.0f}/s)".format(parsed, parsed / (time.time() - started)))
+        if chunk:
+            out_of_bounds += put(chunk)
+        for writer in writers:
+            chunks.put(None)
+        for writer in writers:
+            writer.join()
+        if failures:
+            raise CommandError("import of {} failed: {}".format(label, failures[0]))
+
+        MongoPortalIndex.counters.reconcile()
+        elapsed = time.time() - started
+        self.stdout.write(
+            "Done. {label}: parsed {parsed}, inserted {inserted}, duplicates {duplicates}, errors {errors}, "
+            "out of bounds {out_of_bounds}, malformed {malformed} in {elapsed:.1f}s ({rate:.0f} placemarks/s)".format(
+                label=label, parsed=parsed, malformed=malformed, out_of_bounds=out_of_bounds, elapsed=elapsed,
+                rate=parsed / elapsed if elapsed else 0,
+                **{key: sum(counts[key] for counts in writer_counts)
+                   for key in ('inserted', 'duplicates', 'errors')}))
@@ -0,0 +1,31 @@
+from django.core.management import BaseCommand
+
+from discoverer.portalindex.helpers import MongoHelper
+from discoverer.portalindex.indexes import ensure_indexes, verify_indexes, explain_hot_queries, drop_retired_indexes
+
+
+class Command(BaseCommand):
+    help = "Report, create and explain the mongo indexes the portal index depends on"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--create', action='store_true', default=False, dest='create',
+                            help='create missing indexes and drop retired ones')
+        parser.add_argument('--explain', action='store_true', default=False, dest='explain',
+                            help='log the winning plan of each hot query')
+
+    def handle(self, *args, **options):
+        db = MongoHelper().db
+
+        if options.get('create'):
+            for collection_name, index_name in drop_retired_indexes(db):
+                self.stdout.write("dropped {}.{}".format(collection_name, index_name))
+            for collection_name, index_name in ensure_indexes(db):
+                self.stdout.write("created {}.{}".format(collection_name, index_name))
+
+        for collection_name, index_name, status in verify_indexes(db):
+            self.stdout.write("{}.{}: {}".format(collection_name, index_name, status))
+
+        if options.get('explain'):
+            for query_name, stages, uses_collscan in explain_hot_queries(db):
+                self.stdout.write("{}{}: {}".format(query_name, " [COLLSCAN]" if uses_collscan else "",
+                                                    " <- ".join(stages)))
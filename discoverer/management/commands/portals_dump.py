@@ -0,0 +1,68 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from discoverer.portalindex import bulk
+from discoverer.portalindex.helpers import MongoPortalIndex
+
+
+class Command(BaseCommand):
+    help = "Dump the portals collection to a directory of ndjson or bson files, one per _id range"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory')
+        parser.add_argument('--format', choices=bulk.FORMATS, default=bulk.FORMAT_BSON, dest='format')
+        parser.add_argument('--gzip', action='store_true', default=False, dest='gzip')
+        parser.add_argument('--partitions', type=int, default=multiprocessing.cpu_count(), dest='partitions')
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), dest='processes')
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size')
+        parser.add_argument('--checkpoint-every', type=int, default=10000, dest='checkpoint_every')
+        parser.add_argument('--restart', action='store_true', default=False, dest='restart',
+                            help="discard the checkpoints of an earlier dump into the directory")
+
+    def handle(self, *args, **options):
+        directory = options.get('directory')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if options.get('restart'):
+            for path in bulk.checkpoints(directory) + [os.path.join(directory, bulk.MANIFEST_FILENAME)]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        # the ranges are fixed by the first run, resuming with ranges recomputed from changed data would skip or repeat
+        manifest = bulk.dump_manifest(directory)
+        if manifest is None:
+            ranges = bulk.partition_ranges(MongoPortalIndex.portals, options.get('partitions'))
+            manifest = {
+                'format': options.get('format'),
+                'gzip': options.get('gzip'),
+                'partitions': [{
+                    'file': bulk.dump_filename(i, options.get('format'), options.get('gzip')),
+                    'lower': lower,
+                    'upper': upper,
+                } for i, (lower, upper) in enumerate(ranges)],
+            }
+            bulk.write_dump_manifest(directory, manifest)
+        elif (manifest['format'], manifest['gzip']) != (options.get('format'), options.get('gzip')):
+            raise CommandError("{} holds a {} dump, pass --restart to replace it".format(directory, manifest['format']))
+
+        jobs = [(os.path.join(directory, partition['file']), partition['lower'], partition['upper'],
+                 options.get('batch_size'), options.get('checkpoint_every'))
+                for partition in manifest['partitions']]
+        started = time.time()
+        pool = multiprocessing.Pool(max(1, min(options.get('processes'), len(jobs))))
+        try:
+            states = []
+            for state in pool.imap_unordered(bulk.dump_partition_job, jobs):
+                states.append(state)
+                self.stdout.write("{}/{} partitions dumped".format(len(states), len(jobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        count = bulk.summarize(states).get('count', 0)
+        elapsed = time.time() - started
+        self.stdout.write("Done. dumped {} portals to {} in {:.1f}s ({:.0f}/s)".format(
+            count, directory, elapsed, count / elapsed if elapsed else 0))
@@ -0,0 +1,70 @@
+import multiprocessing
+import os
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from discoverer.portalindex import bulk
+from discoverer.portalindex.helpers import MongoPortalIndex
+from discoverer.portalindex.scheduler import publish_scheduler
+
+
+class Command(BaseCommand):
+    help = "Load a portals_dump directory, or individual ndjson/bson dump files, into the portals collection"
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--mode', choices=bulk.MODES, default=bulk.MODE_INSERT, dest='mode',
+                            help="insert skips portals whose _id exists, upsert replaces them")
+        parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), dest='processes')
+        parser.add_argument('--batch-size', type=int, default=1000, dest='batch_size')
+        parser.add_argument('--restart', action='store_true', default=False, dest='restart',
+                            help="discard the checkpoints of an earlier load of the same files")
+
+    def dump_files(self, paths):
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                manifest = bulk.dump_manifest(path)
+                if manifest is None:
+                    raise CommandError("{} has no {}".format(path, bulk.MANIFEST_FILENAME))
+                files.extend(os.path.join(path, partition['file']) for partition in manifest['partitions'])
+            else:
+                try:
+                    bulk.file_format(path)
+                except ValueError as e:
+                    raise CommandError(str(e))
+                files.append(path)
+        return files
+
+    def handle(self, *args, **options):
+        files = self.dump_files(options.get('paths'))
+        if options.get('restart'):
+            for path in files:
+                if os.path.exists(path + '.load-checkpoint'):
+                    os.remove(path + '.load-checkpoint')
+
+        jobs = [(path, options.get('mode'), options.get('batch_size')) for path in files]
+        started = time.time()
+        pool = multiprocessing.Pool(max(1, min(options.get('processes'), len(jobs))))
+        try:
+            states = []
+            for state in pool.imap_unordered(bulk.load_file_job, jobs):
+                states.append(state)
+                self.stdout.write("{}/{} files loaded".format(len(states), len(jobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        # loaded documents bypass the batch, bring the indexes, counters and published index up to date
+        MongoPortalIndex.ensure_indexes()
+        MongoPortalIndex.counters.reconcile()
+        publish_scheduler.mark_dirty()
+
+        totals = bulk.summarize(states)
+        elapsed = time.time() - started
+        self.stdout.write(
+            "Done. read {count}, written {written}, duplicates {duplicates}, errors {errors} "
+            "in {elapsed:.1f}s ({rate:.0f}/s)".format(
+                elapsed=elapsed, rate=totals.get('count', 0) / elapsed if elapsed else 0,
+                **dict({'count': 0, 'written': 0, 'duplicates': 0, 'errors': 0}, **totals)))
@@ -0,0 +1,43 @@
+from django.core.management import BaseCommand
+from pymongo import UpdateOne
+
+from discoverer.portalindex.helpers import MongoPortalIndex
+
+
+class Command(BaseCommand):
+    help = "Backfill discovered_at and move history beyond the embedded limit to the portal_history collection"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, dest='chunk_size')
+
+    def handle(self, *args, **options):
+        chunk_size = options.get('chunk_size')
+        max_history = MongoPortalIndex.portal_history_max_entries
+        portals = MongoPortalIndex.portals
+
+        cursor = portals.find({"$or": [
+            {"discovered_at": {"$exists": False}},
+            {"_history.{}".format(max_history): {"$exists": True}},
+        ]}, projection={'_history': True, 'discovered_by': True}, batch_size=chunk_size)
+
+        operations = []
+        trimmed = 0
+        for doc in cursor:
+            history = doc.get('_history', [])
+            if not history:
+                continue
+            MongoPortalIndex.archive_history(history)
+            updates = {'_history': history[-max_history:]}
+            if 'discovered_by' not in doc and history[0].get('reporter'):
+                updates['discovered_by'] = history[0]['reporter']
+            operations.append(UpdateOne({'_id': doc['_id']}, {
+                "$min": {'discovered_at': history[0]['timestamp']},
+                "$set": updates,
+            }))
+            if len(operations) >= chunk_size:
+                trimmed += portals.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if operations:
+            trimmed += portals.bulk_write(operations, ordered=False).modified_count
+        MongoPortalIndex.counters.reconcile()
+        self.stdout.write("Done. trimmed {}".format(trimmed))
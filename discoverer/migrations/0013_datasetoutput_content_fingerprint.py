@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('discoverer', '0012_auto_20170624_2142'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datasetoutput',
+            name='content_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=254),
+        ),
+        migrations.AlterUniqueTogether(
+            name='datasetoutput',
+            unique_together=set([]),
+        ),
+    ]
@@ -1,12 +1,19 @@
+import datetime
 import json
+import uuid
 
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.contrib.gis.db import models as gismodels
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.cache import cache
 from django.core.exceptions import MultipleObjectsReturned
 from django.db import models, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
 from discoverer.portalindex.helpers import MongoPortalIndex
+from discoverer.portalindex.regions import RegionIndex
 
 
 class AuditedModel(models.Model):
@@ -51,6 +58,20 @@ class DiscovererUser(AuditedModel, AbstractUser):
         return self.has_perm('discoverer.read_portalinfo')
 
 
+class DatasetOutputManager(models.Manager):
+    def refresh_fingerprints(self):
+        """
+        Compute the content fingerprint of every dataset config and keep it in the cache for get_status.
+        Each reads the portals of its slice, so this runs on the worker after a rebuild and never on a page.
+        """
+        refreshed = {}
+        for dataset in self.all():
+            if dataset.config_hash not in refreshed:
+                refreshed[dataset.config_hash] = dataset.cache_fingerprint(
+                    MongoPortalIndex.content_fingerprint(dataset.get_find_filter()))
+        return refreshed
+
+
 class DatasetOutput(AuditedModel):
     STATUS_READY = 'ready'
     STATUS_BUILDING = 'building'
@@ -63,13 +84,15 @@ class DatasetOutput(AuditedModel):
     filetype = models.CharField(max_length=254, default='kml')
     file = models.FileField(upload_to='dataset-output/')
     portal_index_etag = models.CharField(max_length=254)
+    content_fingerprint = models.CharField(max_length=254, blank=True, default='')
     config_hash = models.CharField(max_length=254)
     stored_config_kwargs = models.TextField()
     status = models.CharField(max_length=254, choices=STATUS_CHOICES, default=STATUS_BUILDING)
 
+    objects = DatasetOutputManager()
+
     class Meta:
         ordering = ('-created_at',)
-        unique_together = ('portal_index_etag', 'config_hash')
         permissions = (
             ("read_kmloutput", "Allowed to download the dataset"),
         )
@@ -89,17 +112,93 @@ class DatasetOutput(AuditedModel):
             updated_at=self.updated_at.strftime('%Y%m%d'),
             ext=self.filetype)
 
+    @property
+    def fingerprint_cache_key(self):
+        return "datasetoutput_fingerprint:{}".format(self.config_hash)
+
+    def cache_fingerprint(self, fingerprint):
+        cache.set(self.fingerprint_cache_key, fingerprint, timeout=None)
+        return fingerprint
+
+    def current_fingerprint(self):
+        """
+        Content fingerprint of the portals this dataset's config selects as of the last rebuild,
+        shared by every dataset of the same config. None until the worker has computed it.
+        """
+        return cache.get(self.fingerprint_cache_key)
+
     def get_status(self):
-        if self.status == self.STATUS_READY and self.portal_index_etag != MongoPortalIndex.get_portal_index_etag():
-            return self.STATUS_STALE
+        cur_tag = MongoPortalIndex.get_portal_index_etag()
+        if self.status == self.STATUS_READY and (cur_tag is None or self.portal_index_etag != cur_tag):
+            # the index changed somewhere or its etag is unknown, only stale if this dataset's slice changed
+            fingerprint = self.current_fingerprint()
+            if not self.content_fingerprint or fingerprint is None or self.content_fingerprint != fingerprint:
+                return self.STATUS_STALE
         return self.status
 
+    def find_twin(self, fingerprint):
+        """
+        Another ready dataset whose file holds the same content: same filetype and options over the same portals.
+        """
+        candidates = DatasetOutput.objects.filter(
+            filetype=self.filetype, content_fingerprint=fingerprint, status=self.STATUS_READY
+        ).exclude(pk=self.pk).exclude(file='')
+        for candidate in candidates:
+            if candidate.config_kwargs.get('options') == self.config_kwargs.get('options'):
+                return candidate
+        return None
+
+    @property
+    def range_geometry(self):
+        value = self.config_kwargs.get('range')
+        if not value:
+            return None
+        geom = GEOSGeometry(value)
+        xmin, ymin, xmax, ymax = geom.extent
+        if max(abs(xmin), abs(xmax)) > 180 or max(abs(ymin), abs(ymax)) > 90:
+            # ranges saved straight from the map widget are in its web mercator projection
+            geom.srid = 3857
+            geom.transform(4326)
+        return geom
+
+    def get_find_filter(self):
+        find_filter = {}
+        geom = self.range_geometry
+        if geom is not None:
+            find_filter['location'] = {'$geoWithin': {'$geometry': json.loads(geom.geojson)}}
+        discovered_after = self.config_kwargs.get('discovered_after')
+        if discovered_after:
+            discovered_date = parse_date(discovered_after)
+            find_filter['discovered_at'] = {
+                '$gte': timezone.make_aware(datetime.datetime.combine(discovered_date, datetime.time.min))
+            }
+        return find_filter
+
     def regenerate(self, force=False):
-        find_args = ()
+        find_args = (self.get_find_filter(),)
         find_kwargs = {}
-        cur_tag = MongoPortalIndex.get_portal_index_etag()
+        # an unknown etag is stored as none, the fingerprint decides whether the file is current
+        cur_tag = MongoPortalIndex.get_portal_index_etag() or ''
 
         if force or (self.status != self.STATUS_READY or not self.file or cur_tag != self.portal_index_etag):
+            fingerprint = self.cache_fingerprint(MongoPortalIndex.content_fingerprint(*find_args))
+            if not force and self.file and fingerprint == self.content_fingerprint:
+                # nothing this dataset selects has changed, the file is still current
+                self.status = self.STATUS_READY
+                self.portal_index_etag = cur_tag
+                self.save()
+                return False
+
+            twin = self.find_twin(fingerprint)
+            if twin is not None and not force:
+                # the same content was already generated for another dataset, share its file
+                self.file.name = twin.file.name
+                self.status = self.STATUS_READY
+                self.portal_index_etag = cur_tag
+                self.content_fingerprint = fingerprint
+                self.save()
+                return True
+
             if self.filetype == 'kml':
                 output = MongoPortalIndex.generate_kml(filename=self.filename,
                                                        *find_args, **find_kwargs)
@@ -110,19 +209,74 @@ class DatasetOutput(AuditedModel):
                                                        *find_args, **find_kwargs)
             else:
                 raise ValueError("Invalid filetype")
-            self.file.save(output.name, output)
+            self.file.save(output.name, output, save=False)
             self.status = self.STATUS_READY
             self.portal_index_etag = cur_tag
+            self.content_fingerprint = fingerprint
             self.save()
             return True
         return False
 
 
 class SearchRegionManager(gismodels.GeoManager, ActiveModelManager):
+    version_cache_key = 'searchregion_active_version'
+
+    def __init__(self, *args, **kwargs):
+        super(SearchRegionManager, self).__init__(*args, **kwargs)
+        self._region_index = None
+        self._region_index_version = None
+
+    def get_active(self):
+        # several regions can be active, this is the first of them
+        return self.filter(is_active=True).first()
+
+    @transaction.atomic
+    def set_active(self, new_active_object):
+        new_active_object.is_active = True
+        new_active_object.save()
+
+    def regions_changed(self):
+        cache.set(self.version_cache_key, uuid.uuid4().hex, timeout=None)
+        # the published snapshot carries the regions
+        from discoverer.portalindex.scheduler import publish_scheduler
+        publish_scheduler.mark_dirty()
+
+    def version(self):
+        """
+        Changes whenever a region is saved or deleted.
+        """
+        version = cache.get(self.version_cache_key)
+        if version is None:
+            cache.add(self.version_cache_key, uuid.uuid4().hex, timeout=None)
+            version = cache.get(self.version_cache_key)
+        return version
+
+    def region_index(self, names=None):
+        """
+        RegionIndex of the active regions, rebuilt in this process only when a region has been saved or deleted.
+        With ``names`` it is built for the regions of those names, active or not, and not kept.
+        """
+        if names is not None:
+            return RegionIndex(((region.name, region.geom) for region in self.filter(name__in=names)))
+
+        version = self.version()
+        if self._region_index is None or version != self._region_index_version:
+            self._region_index = RegionIndex(
+                ((region.name, region.geom) for region in self.filter(is_active=True)),
+                simplify_tolerance=getattr(settings, 'SEARCH_REGION_SIMPLIFY_TOLERANCE', 0.0005))
+            self._region_index_version = version
+        return self._region_index
+
     def get_active_coordinates(self):
-        active = self.get_active()
-        if active:
-            return active.geom.coords[0]
+        """
+        Outer ring of the first active region, for clients that only know about a single region.
+        """
+        coordinates = self.region_index().coordinates
+        if coordinates:
+            return coordinates[0]
+
+    def get_active_polygons(self):
+        return self.region_index().coordinates
 
 
 class SearchRegion(AuditedModel):
@@ -134,3 +288,13 @@ class SearchRegion(AuditedModel):
 
     class Meta:
         ordering = ('name',)
+
+    def save(self, *args, **kwargs):
+        ret = super(SearchRegion, self).save(*args, **kwargs)
+        SearchRegion.objects.regions_changed()
+        return ret
+
+    def delete(self, *args, **kwargs):
+        ret = super(SearchRegion, self).delete(*args, **kwargs)
+        SearchRegion.objects.regions_changed()
+        return ret
@@ -0,0 +1,235 @@
+import gzip
+import os
+import struct
+
+from bson import json_util, ObjectId
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from discoverer.portalindex.helpers import MongoHelper
+
+FORMAT_NDJSON = 'ndjson'
+FORMAT_BSON = 'bson'
+FORMATS = (FORMAT_NDJSON, FORMAT_BSON)
+
+MODE_INSERT = 'insert'
+MODE_UPSERT = 'upsert'
+MODES = (MODE_INSERT, MODE_UPSERT)
+
+DUPLICATE_KEY_ERROR = 11000
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+def dump_filename(index, fmt, compress):
+    return "portals.{:04d}.{}{}".format(index, fmt, '.gz' if compress else '')
+
+
+def file_format(path):
+    name = path[:-len('.gz')] if path.endswith('.gz') else path
+    for candidate in FORMATS:
+        if name.endswith('.' + candidate):
+            return candidate
+    raise ValueError("unknown format for {}".format(path))
+
+
+def read_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fh:
+        return json_util.loads(fh.read())
+
+
+def write_json(path, value):
+    # written aside and renamed over, so a crash never leaves half a checkpoint
+    with open(path + '.tmp', 'w') as fh:
+        fh.write(json_util.dumps(value))
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(path + '.tmp', path)
+
+
+def partition_ranges(collection, partitions):
+    """
+    Split the collection into ``partitions`` (lower, upper) _id ranges, lower inclusive and upper exclusive,
+    None meaning unbounded. ObjectIds are split evenly over the time span they were created in.
+    """
+    first = collection.find_one(sort=[('_id', 1)], projection={'_id': True})
+    last = collection.find_one(sort=[('_id', -1)], projection={'_id': True})
+    if first is None:
+        return []
+    if partitions <= 1 or not isinstance(first['_id'], ObjectId) or not isinstance(last['_id'], ObjectId):
+        return [(None, None)]
+
+    start = first['_id'].generation_time
+    step = (last['_id'].generation_time - start) // partitions
+    bounds = []
+    for i in range(1, partitions):
+        bound = ObjectId.from_datetime(start + step * i)
+        if not bounds or bound > bounds[-1]:
+            bounds.append(bound)
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _id_query(lower=None, upper=None, after=None):
+    query = {}
+    if lower is not None:
+        query['$gte'] = lower
+    if upper is not None:
+        query['$lt'] = upper
+    if after is not None:
+        query['$gt'] = after
+    return {'_id': query} if query else {}
+
+
+def _encode(docs, fmt):
+    if fmt == FORMAT_BSON:
+        return b''.join(doc.raw for doc in docs)
+    return b''.join(json_util.dumps(doc) + b'\n' for doc in docs)
+
+
+def dump_partition(path, lower, upper, batch_size=1000, checkpoint_every=10000):
+    """
+    Write the portals with lower <= _id < upper to ``path`` in _id order, resuming from its checkpoint.
+    Each checkpoint is taken after a complete (gzip member of) output, so a resumed dump truncates back to it.
+    Runs in a pool process, so it opens its own mongo connection.
+    """
+    checkpoint_path = path + '.checkpoint'
+    state = read_json(checkpoint_path) or {'last_id': None, 'offset': 0, 'count': 0, 'done': False}
+    if state['done']:
+        return state
+
+    fmt = file_format(path)
+    compress = path.endswith('.gz')
+    collection = MongoHelper().db.portals
+    if fmt == FORMAT_BSON:
+        collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    cursor = collection.find(_id_query(lower, upper, state['last_id']), sort=[('_id', 1)], batch_size=batch_size)
+
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as fh:
+        fh.seek(state['offset'])
+        fh.truncate()
+
+        def checkpoint(docs):
+            data = _encode(docs, fmt)
+            if compress:
+                member = gzip.GzipFile(fileobj=fh, mode='wb')
+                member.write(data)
+                member.close()
+            else:
+                fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+            state.update(last_id=docs[-1]['_id'], offset=fh.tell(), count=state['count'] + len(docs))
+            write_json(checkpoint_path, state)
+
+        pending = []
+        for doc in cursor:
+            pending.append(doc)
+            if len(pending) >= checkpoint_every:
+                checkpoint(pending)
+                pending = []
+        if pending:
+            checkpoint(pending)
+
+    state['done'] = True
+    write_json(checkpoint_path, state)
+    return state
+
+
+def iter_documents(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as fh:
+        if file_format(path) == FORMAT_BSON:
+            while True:
+                head = fh.read(4)
+                if not head:
+                    return
+                size = struct.unpack('<i', head)[0]
+                yield RawBSONDocument(head + fh.read(size - 4))
+        else:
+            for line in fh:
+                if line.strip():
+                    yield json_util.loads(line)
+
+
+def load_file(path, mode=MODE_INSERT, batch_size=1000):
+    """
+    Write the documents of a dump file to the portals collection, resuming after the last checkpointed batch.
+    Inserting counts documents whose _id already exists as duplicates, upserting replaces them.
+    """
+    checkpoint_path = path + '.load-checkpoint'
+    state = read_json(checkpoint_path) or {'count': 0, 'written': 0, 'duplicates': 0, 'errors': 0, 'done': False}
+    if state['done']:
+        return state
+
+    collection = MongoHelper().db.portals
+
+    def checkpoint(docs):
+        try:
+            if mode == MODE_UPSERT:
+                result = collection.bulk_write([ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in docs],
+                                               ordered=False)
+                state['written'] += result.upserted_count + result.modified_count
+            else:
+                state['written'] += len(collection.insert_many(docs, ordered=False).inserted_ids)
+        except BulkWriteError as e:
+            state['written'] += (e.details.get('nInserted', 0) + e.details.get('nUpserted', 0) +
+                                 e.details.get('nModified', 0))
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == DUPLICATE_KEY_ERROR:
+                    state['duplicates'] += 1
+                else:
+                    state['errors'] += 1
+        state['count'] += len(docs)
+        write_json(checkpoint_path, state)
+
+    skip = state['count']
+    pending = []
+    for i, doc in enumerate(iter_documents(path)):
+        if i < skip:
+            continue
+        pending.append(doc)
+        if len(pending) >= batch_size:
+            checkpoint(pending)
+            pending = []
+    if pending:
+        checkpoint(pending)
+
+    state['done'] = True
+    write_json(checkpoint_path, state)
+    return state
+
+
+def dump_partition_job(args):
+    # pool.imap takes a single argument
+    return dump_partition(*args)
+
+
+def load_file_job(args):
+    return load_file(*args)
+
+
+def dump_manifest(directory):
+    return read_json(os.path.join(directory, MANIFEST_FILENAME))
+
+
+def write_dump_manifest(directory, manifest):
+    write_json(os.path.join(directory, MANIFEST_FILENAME), manifest)
+
+
+def checkpoints(directory):
+    return [os.path.join(directory, name) for name in os.listdir(directory)
+            if name.endswith('.checkpoint') or name.endswith('.load-checkpoint')]
+
+
+def summarize(states):
+    totals = {}
+    for state in states:
+        for key, value in state.items():
+            if isinstance(value, (int, long)) and not isinstance(value, bool) and key != 'offset':
+                totals[key] = totals.get(key, 0) + value
+    return totals
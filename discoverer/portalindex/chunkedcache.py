@@ -0,0 +1,85 @@
+import uuid
+import zlib
+
+from django.core.cache import cache as default_cache
+
+
+class ChunkedCache(object):
+    """
+    Stores values too large for a single cache item (memcached refuses anything over 1MB)
+    as numbered chunks of a compressed payload, behind a manifest naming the version they belong to.
+    A missing, torn or corrupt set of chunks reads back as a miss.
+    The chunks of a replaced version are kept for ``retired_timeout`` seconds, so readers
+    that fetched its manifest just before the swap still find them.
+    """
+    chunk_size = 900 * 1024
+    retired_timeout = 5 * 60
+
+    def __init__(self, cache=None, chunk_size=None, compress=True, compress_level=6, retired_timeout=None):
+        self._cache = cache
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if retired_timeout is not None:
+            self.retired_timeout = retired_timeout
+        self.compress = compress
+        self.compress_level = compress_level
+
+    @property
+    def cache(self):
+        return self._cache if self._cache is not None else default_cache
+
+    def _chunk_keys(self, key, manifest):
+        return ["{}:{}:{}".format(key, manifest['version'], n) for n in range(manifest['chunks'])]
+
+    def set(self, key, value, timeout=None):
+        payload = zlib.compress(value, self.compress_level) if self.compress else value
+        manifest = {
+            'version': uuid.uuid4().hex,
+            'chunks': max(1, (len(payload) + self.chunk_size - 1) // self.chunk_size),
+            'length': len(payload),
+            'crc': zlib.crc32(payload) & 0xffffffff,
+            'compressed': self.compress,
+        }
+        chunk_keys = self._chunk_keys(key, manifest)
+        self.cache.set_many({
+            chunk_key: payload[n*self.chunk_size:(n+1)*self.chunk_size] for n, chunk_key in enumerate(chunk_keys)
+        }, timeout=timeout)
+
+        previous = self.cache.get(key)
+        # the manifest goes last so readers never see a version whose chunks aren't stored yet
+        self.cache.set(key, manifest, timeout=timeout)
+        if isinstance(previous, dict) and 'version' in previous:
+            # stored again rather than deleted, they expire once no reader can still hold the old manifest
+            retired = self.cache.get_many(self._chunk_keys(key, previous))
+            if retired:
+                self.cache.set_many(retired, timeout=self.retired_timeout)
+        return manifest
+
+    def _read(self, key, manifest):
+        chunk_keys = self._chunk_keys(key, manifest)
+        chunks = self.cache.get_many(chunk_keys)
+        if len(chunks) != len(chunk_keys):
+            return None
+        payload = b''.join(chunks[chunk_key] for chunk_key in chunk_keys)
+        if len(payload) != manifest['length'] or (zlib.crc32(payload) & 0xffffffff) != manifest['crc']:
+            return None
+        return zlib.decompress(payload) if manifest['compressed'] else payload
+
+    def get(self, key, default=None):
+        read_version = None
+        # a torn read is retried once against the manifest as it is now, in case a set swapped it meanwhile
+        for attempt in range(2):
+            manifest = self.cache.get(key)
+            if not isinstance(manifest, dict) or 'version' not in manifest or manifest['version'] == read_version:
+                return default
+            value = self._read(key, manifest)
+            if value is not None:
+                return value
+            read_version = manifest['version']
+        return default
+
+    def delete(self, key):
+        manifest = self.cache.get(key)
+        if isinstance(manifest, dict) and 'version' in manifest:
+            self.cache.delete_many(self._chunk_keys(key, manifest))
+        self.cache.delete(key)
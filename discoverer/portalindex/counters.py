@@ -0,0 +1,100 @@
+from pymongo import UpdateOne, ReplaceOne
+
+
+class PortalCounters(object):
+    """
+    Portal totals kept in the portal_counters collection: the number of portals, and how many were
+    discovered in each region and by each reporter.
+    They are moved by the outcome of each bulk write, so reading one is a lookup by _id.
+    ``reconcile`` recounts them from the portals collection to correct any drift.
+    """
+    collection_name = 'portal_counters'
+    total_id = 'portals'
+    region_prefix = 'region:'
+    reporter_prefix = 'reporter:'
+
+    def __init__(self, index):
+        self.index = index
+
+    @property
+    def collection(self):
+        return self.index.mongo.collection(self.collection_name)
+
+    def increment(self, counts):
+        """
+        Add ``counts``, a dict of counter id to amount, creating counters that don't exist yet.
+        """
+        operations = [UpdateOne({'_id': counter_id}, {"$inc": {'n': amount}}, upsert=True)
+                      for counter_id, amount in counts.items() if amount]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    def record(self, result):
+        """
+        Count the portals a PortalBatchResult inserted.
+        """
+        counts = {}
+        for doc, item in zip(result.docs, result.items):
+            if item['status'] != result.STATUS_UPSERTED:
+                continue
+            counts[self.total_id] = counts.get(self.total_id, 0) + 1
+            if doc.get('region'):
+                region_id = self.region_prefix + doc['region']
+                counts[region_id] = counts.get(region_id, 0) + 1
+            if doc.get('reporter'):
+                reporter_id = self.reporter_prefix + doc['reporter']
+                counts[reporter_id] = counts.get(reporter_id, 0) + 1
+        self.increment(counts)
+        return counts
+
+    def get(self, counter_id, default=None):
+        counter = self.collection.find_one({'_id': counter_id})
+        if counter is None:
+            return default
+        return counter['n']
+
+    @property
+    def total(self):
+        total = self.get(self.total_id)
+        if total is None:
+            total = self.reconcile_total()
+        return total
+
+    def _prefixed(self, prefix):
+        return {counter['_id'][len(prefix):]: counter['n']
+                for counter in self.collection.find({'_id': {'$regex': '^' + prefix}})}
+
+    def regions(self):
+        return self._prefixed(self.region_prefix)
+
+    def reporters(self):
+        return self._prefixed(self.reporter_prefix)
+
+    def reconcile_total(self):
+        # count() without a filter is answered from the collection metadata, it doesn't scan
+        total = self.index.portals.count()
+        self.collection.replace_one({'_id': self.total_id}, {'_id': self.total_id, 'n': total}, upsert=True)
+        return total
+
+    def _recount(self, prefix, field):
+        counts = {row['_id']: row['n'] for row in self.index.portals.aggregate([
+            {"$match": {field: {"$exists": True}}},
+            {"$group": {'_id': '$' + field, 'n': {"$sum": 1}}},
+        ], allowDiskUse=True)}
+        operations = [ReplaceOne({'_id': prefix + name}, {'_id': prefix + name, 'n': n}, upsert=True)
+                      for name, n in counts.items()]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+        self.collection.delete_many({'_id': {'$regex': '^' + prefix, '$nin': [prefix + name for name in counts]}})
+        return counts
+
+    def reconcile(self):
+        """
+        Recount every counter from the portals collection. The grouped counts read the whole collection,
+        so this belongs with the periodic rebuild on the worker and never on a request.
+        """
+        return {
+            'total': self.reconcile_total(),
+            'regions': self._recount(self.region_prefix, 'region'),
+            'reporters': self._recount(self.reporter_prefix, 'discovered_by'),
+        }
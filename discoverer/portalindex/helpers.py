@@ -1,17 +1,110 @@
 import StringIO
+import binascii
 import csv
+import datetime
+import gzip
+import itertools
 import json
+import math
+import re
+import struct
+import tempfile
+import time
 import uuid
+from collections import OrderedDict
 from hashlib import sha1
 
 import os
 import pymongo
+from django.conf import settings
 from django.core.cache import cache
-from django.core.files.base import ContentFile
+from django.core.files.base import File
 from django.utils import timezone
 from lxml import etree
 from pykml.factory import KML_ElementMaker
-from pymongo.errors import InvalidOperation
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+
+from discoverer.portalindex.chunkedcache import ChunkedCache
+from discoverer.portalindex.counters import PortalCounters
+from discoverer.portalindex.indexes import ensure_indexes
+
+KML_NAMESPACE = 'http://www.opengis.net/kml/2.2'
+
+
+def _kml_tag(name):
+    return "{{{}}}{}".format(KML_NAMESPACE, name)
+
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def gzip_compress(data, compresslevel=9):
+    buf = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=compresslevel) as fh:
+        fh.write(data)
+    return buf.getvalue()
+
+
+def discovered_at(doc):
+    """
+    First discovery time of a portal document, falling back to its oldest embedded history entry.
+    """
+    if doc.get('discovered_at') is not None:
+        return doc['discovered_at']
+    return doc['_history'][0]['timestamp']
+
+
+_binary_guid_re = re.compile(r'^([0-9a-f]{32})\.[0-9]+$')
+
+
+def binary_guid(guid):
+    """
+    Returns the 16 byte key of a portal guid for the binary index, or None if it isn't in the usual hex form.
+    """
+    match = _binary_guid_re.match(guid) if guid else None
+    if match:
+        return binascii.unhexlify(match.group(1))
+
+
+INDEX_CONTENT_ENCODERS = [('gzip', gzip_compress)]
+if brotli is not None:
+    INDEX_CONTENT_ENCODERS.insert(0, ('br', lambda data: brotli.compress(data, quality=11)))
+
+
+def portal_ref_key(latE6, lngE6, name, guid=None):
+    return u"{lat}|{lng}|{name}|{guid}".format(lat=latE6, lng=lngE6, name=name,
+                                               guid=guid if guid is not None else "null")
+
+
+def portal_ref(latE6, lngE6, name, guid=None):
+    """
+    The _ref of a portal, the plugin computes the same digest in _portal_ref.
+    """
+    return sha1(portal_ref_key(latE6, lngE6, name, guid).encode('utf-8')).hexdigest()
+
+
+def _portal_refs_chunk(rows):
+    return [portal_ref(*row) for row in rows]
+
+
+def portal_refs(latE6s, lngE6s, names, guids=None, pool=None, chunk_size=None):
+    """
+    _refs for columns of portal fields, in order.
+    With a multiprocessing ``pool`` the rows are hashed in chunks of ``chunk_size`` across its processes.
+    """
+    if guids is None:
+        guids = itertools.repeat(None)
+    rows = list(itertools.izip(latE6s, lngE6s, names, guids))
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'PORTAL_REF_CHUNK_SIZE', 10000)
+    if pool is None or len(rows) <= chunk_size:
+        return _portal_refs_chunk(rows)
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    return list(itertools.chain.from_iterable(pool.map(_portal_refs_chunk, chunks)))
 
 
 class MongoHelper(object):
@@ -36,15 +129,52 @@ class MongoHelper(object):
 
 class PortalIndexHelper(object):
     portal_index_cache_key = 'portalindexhelper_portal_index'
-    portal_index_timestamp_cache_key = 'portalindexhelper_portal_index_timestamp'
-    portal_index_etag_cache_key = 'portalindexhelper_portal_index_etag'
-    portal_index_count_cache_key = 'portalindexhelper_portal_index_count'
+    # each under its own key, so publishing one never writes back a stale copy of another
+    portal_index_version_cache_keys = {
+        'etag': 'portalindexhelper_portal_index_etag',
+        'timestamp': 'portalindexhelper_portal_index_timestamp',
+        'snapshot': 'portalindexhelper_portal_index_snapshot',
+    }
+    portal_index_seq_cache_key = 'portalindexhelper_portal_index_seq'
+    portal_index_tiles_cache_key = 'portalindexhelper_portal_index_tiles'
     guid_index_collection_name = "portals_guid_ref_map"
+    guid_index_log_collection_name = "portals_guid_ref_log"
+    # pairs per log document, at about 100 bytes a pair well under mongo's 16MB document limit
+    guid_index_log_max_changes = 20000
+    portal_history_collection_name = "portal_history"
+    csv_projection = {
+        'guid': True,
+        'name': True,
+        'location.coordinates': True,
+        'region': True,
+        'discovered_at': True,
+        '_history': {'$slice': 1},
+    }
+    kml_projection = {
+        '_history': {'$slice': 1},
+    }
+    binary_index_magic = b'PIDX'
+    binary_index_version = 1
+    binary_index_key_size = 16
+    binary_index_digest_size = 8
 
     def __init__(self):
         self._portals = None
         self._mongo = None
-        self._bulk_op = None
+        self.index_cache = ChunkedCache()
+        self.encoded_index_cache = ChunkedCache(compress=False)
+        self._version = None
+        self._version_probed_at = 0
+        self._local_bodies = OrderedDict()
+        self.local_bodies_max_entries = 8
+        self._ref_index = None
+        self._ref_index_seq = None
+        self._guid_index_published = False
+        self.counters = PortalCounters(self)
+
+    @property
+    def export_batch_size(self):
+        return getattr(settings, 'DATASET_OUTPUT_CURSOR_BATCH_SIZE', 1000)
 
     @property
     def mongo(self):
@@ -58,125 +188,502 @@ class PortalIndexHelper(object):
             self._portals = self.mongo.db.portals
         return self._portals
 
+    def ensure_indexes(self):
+        return ensure_indexes(self.mongo.db)
+
     @classmethod
     def sha_hash(cls, doc):
-        key = u"{lat}|{lng}|{name}|{guid}".format(
-            lat=int(doc['location']['coordinates'][1]*1e6),
-            lng=int(doc['location']['coordinates'][0]*1e6),
-            name=doc['name'],
-            guid=doc.get('guid', "null")
-        )
-        hash = sha1(key.encode('utf-8')).hexdigest()
-        return hash
+        # rounded, not truncated, latE6/1e6*1e6 doesn't always come back to latE6
+        return portal_ref(int(round(doc['location']['coordinates'][1]*1e6)),
+                          int(round(doc['location']['coordinates'][0]*1e6)),
+                          doc['name'], doc.get('guid'))
 
     @property
-    def bulk_op(self):
-        if self._bulk_op is None:
-            self._bulk_op = self.portals.initialize_ordered_bulk_op()
-        return self._bulk_op
-
-    def bulk_op_execute(self):
-        if self._bulk_op is not None:
-            try:
-                result = self._bulk_op.execute()
-                return result
-            except InvalidOperation:
-                pass
-            finally:
-                self._bulk_op = None
-
-    def update_portal(self, latE6, lngE6, name, guid=None, timestamp=None, created_by=None, region=None):
-        if timestamp is None:
-            timestamp = timezone.now()
+    def portal_history_max_entries(self):
+        return getattr(settings, 'PORTAL_HISTORY_MAX_ENTRIES', 10)
 
-        new_doc = {
-            'location': {
-                "type": "Point",
-                "coordinates": [lngE6/1e6, latE6/1e6]
-            },
-            'name': name,
-            'timestamp': timestamp,
-        }
-
-        or_operations = [{'guid': {"$exists": False}, 'location.coordinates': [lngE6/1e6, latE6/1e6]}]
-        if guid is not None:
-            or_operations.insert(0, {'guid': guid})
-            new_doc['guid'] = guid
-
-        new_doc['_ref'] = self.sha_hash(new_doc)
-        if created_by:
-            new_doc['reporter'] = created_by.username
-        if region:
-            new_doc['region'] = region
-
-        self.bulk_op.find({
-            "$or": or_operations
-        }).upsert().update({
-            "$set": new_doc,
-            "$push": {
-                "_history": new_doc
-            }
-        })
+    @property
+    def portal_history(self):
+        return self.mongo.db[self.portal_history_collection_name]
+
+    def archive_history(self, entries):
+        """
+        Keep every history entry in the portal_history collection, the embedded _history only holds the latest few.
+        Entries are keyed on their _ref and timestamp, so archiving the same one twice is a no-op
+        while a portal returning to an earlier state is kept as a new entry.
+        """
+        if not entries:
+            return
+        try:
+            self.portal_history.bulk_write([
+                UpdateOne({'_ref': entry['_ref'], 'timestamp': entry['timestamp']}, {'$setOnInsert': entry},
+                          upsert=True) for entry in entries
+            ], ordered=False)
+        except BulkWriteError:
+            # concurrent archivers racing on the unique key, the entry is stored either way
+            pass
+
+    def batch(self, created_by=None, skip_unchanged=False, check_regions=False):
+        regions = None
+        if check_regions:
+            from discoverer.models import SearchRegion
+            regions = SearchRegion.objects.region_index()
+        return PortalBatch(self, created_by=created_by, skip_unchanged=skip_unchanged, regions=regions,
+                           reject_outside=getattr(settings, 'SEARCH_REGION_REJECT_OUTSIDE', False))
+
+    def known_refs(self):
+        """
+        In-process guid -> _ref map of the published index, kept current from the delta log.
+        """
+        seq = self.portal_index_seq
+        changes = None
+        if self._ref_index is not None and seq != self._ref_index_seq:
+            changes = self.guid_index_changes_since(self._ref_index_seq)
+        if self._ref_index is None or (seq != self._ref_index_seq and changes is None):
+            if self.guid_index_collection_name in self.mongo.db.collection_names():
+                self._ref_index = self._read_guid_index()
+            else:
+                self._ref_index = {}
+        elif changes:
+            self._ref_index.update(changes)
+        self._ref_index_seq = seq
+        return self._ref_index
 
     def publish_guid_index(self):
+        had_index = self.guid_index_collection_name in self.mongo.db.collection_names()
+        previous = self._read_guid_index() if had_index else {}
         self.portals.aggregate([
             {"$match": {"guid": {"$exists": True}}},
-            {"$project": {"_ref": 1, "guid": 1}},
+            {"$project": {"_ref": 1, "guid": 1, "location.coordinates": 1}},
             {"$out": self.guid_index_collection_name}
         ])
-        self.publish()
+        index = self._read_guid_index()
+        if previous:
+            changes = {guid: ref for guid, ref in index.items() if previous.get(guid) != ref}
+        else:
+            changes = None
+        if changes is None or len(changes) > self.guid_index_log_max_changes:
+            # nothing to diff against, or a diff so large that a full snapshot is cheaper for clients,
+            # anyone holding a sequence number needs one
+            self.append_guid_index_log(None)
+        elif changes:
+            self.append_guid_index_log(changes)
+        published_seq = self.publish(index=index)
+        self.publish_tiles()
+        self.prune_guid_index_log(published_seq)
+
+    def publish_guid_index_changes(self, refs):
+        """
+        Apply guid -> _ref pairs from a bulk write straight to the published index,
+        so the cost depends on the number of changes rather than the collection size.
+        Until a full rebuild has published the index there is nothing to apply them to,
+        the changes are left for that rebuild.
+        """
+        if not refs or not self.guid_index_published:
+            return {}
+        guid_index = self.mongo.db[self.guid_index_collection_name]
+        current = {r.get('guid'): r.get('_ref') for r in guid_index.find({'guid': {'$in': list(refs.keys())}})}
+        changes = {guid: ref for guid, ref in refs.items() if current.get(guid) != ref}
+        if not changes:
+            return {}
+
+        guid_index.bulk_write([
+            UpdateOne({'guid': guid}, {'$set': {'_ref': ref}}, upsert=True) for guid, ref in changes.items()
+        ], ordered=False)
+        self.append_guid_index_log(changes)
+        self._set_version(etag=str(uuid.uuid4()), timestamp=timezone.now())
+        return changes
+
+    @property
+    def guid_index_published(self):
+        """
+        True once a full rebuild has published the guid index, which always records a log entry.
+        The map collection alone doesn't tell, creating its indexes creates it empty.
+        """
+        if not self._guid_index_published:
+            self._guid_index_published = self.portal_index_seq > 0
+        return self._guid_index_published
+
+    @property
+    def guid_index_log(self):
+        return self.mongo.db[self.guid_index_log_collection_name]
+
+    @property
+    def portal_index_seq(self):
+        seq = cache.get(self.portal_index_seq_cache_key)
+        if seq is None:
+            last = self.guid_index_log.find_one(sort=[('_id', pymongo.DESCENDING)])
+            seq = last['_id'] if last else 0
+            cache.set(self.portal_index_seq_cache_key, seq, timeout=None)
+        return seq
+
+    def append_guid_index_log(self, changes):
+        """
+        Record a set of guid -> _ref changes under the next sequence number, split over several
+        when there are more than fit in one log document.
+        Passing None records a reset: clients behind it must fetch a full snapshot.
+        """
+        if changes is None:
+            parts = [None]
+        else:
+            # guids contain dots so they can't be used as mongo keys, store pairs instead
+            pairs = [[guid, ref] for guid, ref in changes.items()]
+            parts = [pairs[i:i + self.guid_index_log_max_changes]
+                     for i in range(0, len(pairs), self.guid_index_log_max_changes)]
+        last = self.guid_index_log.find_one(sort=[('_id', pymongo.DESCENDING)])
+        seq = last['_id'] if last else 0
+        for part in parts:
+            entry = {'k': part, 'timestamp': timezone.now()}
+            while True:
+                seq += 1
+                entry['_id'] = seq
+                try:
+                    self.guid_index_log.insert_one(entry)
+                    break
+                except DuplicateKeyError:
+                    continue
+        cache.set(self.portal_index_seq_cache_key, seq, timeout=None)
+        return seq
+
+    @property
+    def guid_index_log_retention_seconds(self):
+        return getattr(settings, 'PORTAL_INDEX_LOG_RETENTION_SECONDS', 2*60*60)
+
+    def prune_guid_index_log(self, published_seq):
+        """
+        Drop the log entries the snapshot published at ``published_seq`` already holds,
+        once they are older than PORTAL_INDEX_LOG_RETENTION_SECONDS.
+        Everything after the published snapshot is kept, however many entries that is,
+        so clients catching up from it never fall back to a full snapshot.
+        """
+        # the entry at published_seq stays, the sequence carries on from the latest entry
+        self.guid_index_log.delete_many({
+            '_id': {'$lt': published_seq},
+            'timestamp': {'$lt': timezone.now() - datetime.timedelta(seconds=self.guid_index_log_retention_seconds)},
+        })
 
-    def publish(self):
+    def guid_index_changes_since(self, since):
+        """
+        Returns a dict of guid -> _ref published after sequence number ``since``,
+        or None if the log doesn't reach back that far and a full snapshot is needed.
+        """
+        seq = self.portal_index_seq
+        if since > seq:
+            return None
+        if since == seq:
+            return {}
+        changes = {}
+        expected = since + 1
+        for entry in self.guid_index_log.find({'_id': {'$gt': since}}).sort('_id', pymongo.ASCENDING):
+            if entry['_id'] != expected or entry.get('k') is None:
+                return None
+            changes.update(dict(entry['k']))
+            expected += 1
+        if expected <= seq:
+            return None
+        return changes
+
+    def index_changes_json(self, since):
         from discoverer.models import SearchRegion
-        self._index_json = json.dumps({
-            'k': self.guid_index(),
-            'r': SearchRegion.objects.get_active_coordinates()
+        seq = self.portal_index_seq
+        changes = self.guid_index_changes_since(since)
+        if changes is None:
+            return None
+        return json.dumps({
+            'k': changes,
+            'r': SearchRegion.objects.get_active_coordinates(),
+            'rs': SearchRegion.objects.get_active_polygons(),
+            's': seq,
+            'd': 1,
         })
-        cache.set(self.portal_index_cache_key, self._index_json, timeout=None)
-        cache.set(self.portal_index_timestamp_cache_key, timezone.now(), timeout=None)
-        cache.set(self.portal_index_etag_cache_key, str(uuid.uuid4()), timeout=None)
-        cache.set(self.portal_index_count_cache_key, self.portals.find().count(), timeout=None)
+
+    def publish(self, index=None):
+        from discoverer.models import SearchRegion
+        # read the sequence first so the snapshot holds at least everything up to it
+        seq = self.portal_index_seq
+        index_dict = index if index is not None else self.guid_index()
+        index_json = json.dumps({
+            'k': index_dict,
+            'r': SearchRegion.objects.get_active_coordinates(),
+            'rs': SearchRegion.objects.get_active_polygons(),
+            's': seq,
+        })
+        # encode once per publish so serving the index never compresses per request
+        bodies = {None: index_json}
+        self.index_cache.set(self.portal_index_cache_key, index_json, timeout=None)
+        for encoding, encoder in INDEX_CONTENT_ENCODERS:
+            bodies[encoding] = encoder(index_json)
+            self.encoded_index_cache.set(self._index_cache_key(encoding), bodies[encoding], timeout=None)
+        bodies['bin'] = self.encode_binary_index(index_dict, seq)
+        self.encoded_index_cache.set(self._index_cache_key('bin'), bodies['bin'], timeout=None)
+
+        # the version goes last, it is what other processes probe before trusting their local copies
+        snapshot = uuid.uuid4().hex
+        self._set_version(etag=str(uuid.uuid4()), timestamp=timezone.now(), snapshot=snapshot)
+        for variant, body in bodies.items():
+            self._remember_body(snapshot, variant, body)
+        return seq
+
+    def encode_binary_index(self, index, seq):
+        """
+        Pack a guid -> _ref index as a 16 byte header followed by sorted fixed width guid keys
+        and the matching truncated _ref digests, so clients can binary search it from typed arrays.
+        Guids that aren't in the usual hex form are left out, clients treat them as unknown.
+        """
+        digest_hex_length = self.binary_index_digest_size*2
+        entries = []
+        for guid, ref in index.items():
+            key = binary_guid(guid)
+            if key is not None and ref:
+                entries.append((key, binascii.unhexlify(ref[:digest_hex_length])))
+        entries.sort()
+
+        header = struct.pack('<4sBBHII', self.binary_index_magic, self.binary_index_version,
+                             self.binary_index_key_size, self.binary_index_digest_size, len(entries), seq)
+        return b''.join([header] + [key for key, digest in entries] + [digest for key, digest in entries])
+
+    @property
+    def local_probe_seconds(self):
+        return getattr(settings, 'PORTAL_INDEX_LOCAL_PROBE_SECONDS', 1)
+
+    def index_version(self):
+        """
+        The published etag, timestamp and snapshot id, read from the shared cache
+        at most once per PORTAL_INDEX_LOCAL_PROBE_SECONDS in this process.
+        """
+        now = time.time()
+        if self._version is None or now - self._version_probed_at >= self.local_probe_seconds:
+            values = cache.get_many(self.portal_index_version_cache_keys.values())
+            self._version = {field: values[key] for field, key in self.portal_index_version_cache_keys.items()
+                             if key in values}
+            self._version_probed_at = now
+        return self._version
+
+    def _set_version(self, **changes):
+        # only the given fields are written, there is no read-modify-write to race with other publishers
+        cache.set_many({self.portal_index_version_cache_keys[field]: value for field, value in changes.items()},
+                       timeout=None)
+        self._version = dict(self._version or {}, **changes)
+        self._version_probed_at = time.time()
+
+    def _remember_body(self, snapshot, variant, body):
+        key = (snapshot, variant)
+        self._local_bodies.pop(key, None)
+        self._local_bodies[key] = body
+        while len(self._local_bodies) > self.local_bodies_max_entries:
+            self._local_bodies.popitem(last=False)
+
+    def _local_body(self, variant, load):
+        """
+        Returns the body of ``variant`` for the current snapshot from this process if it has it,
+        only going to the shared cache (through ``load``) when the snapshot has changed.
+        On a miss it falls back to the latest body this process holds, None if it holds none.
+        """
+        key = (self.index_version().get('snapshot'), variant)
+        if key[0] is not None and key in self._local_bodies:
+            body = self._local_bodies.pop(key)
+            self._local_bodies[key] = body
+            return body
+        body = load()
+        if not body:
+            # never published or evicted, the rebuild runs on the worker and this serves what it last had meanwhile
+            from discoverer.portalindex.scheduler import publish_scheduler
+            publish_scheduler.mark_dirty()
+            return self._latest_local_body(variant)
+        snapshot = self.index_version().get('snapshot')
+        if snapshot is not None:
+            self._remember_body(snapshot, variant, body)
+        return body
+
+    def _latest_local_body(self, variant):
+        for (snapshot, remembered_variant), body in reversed(self._local_bodies.items()):
+            if remembered_variant == variant:
+                return body
+        return None
 
     @property
     def portal_index_count(self):
-        count = cache.get(self.portal_index_count_cache_key)
-        if not count:
-            self.publish()
-            count = cache.get(self.portal_index_count_cache_key)
-        return count
+        return self.counters.total
 
     @property
     def portal_index_last_modified(self):
-        timestamp = cache.get(self.portal_index_timestamp_cache_key)
+        timestamp = self.index_version().get('timestamp')
         if timestamp is not None:
             return timestamp
         return timezone.now()
 
     @property
     def portal_index_etag(self):
-        etag = cache.get(self.portal_index_etag_cache_key)
+        etag = self.index_version().get('etag')
         return etag
 
-    def get_portal_index_etag(self, publish_if_needed=True):
-        cur_tag = cache.get(MongoPortalIndex.portal_index_etag_cache_key)
-        if cur_tag is None and publish_if_needed:
-            MongoPortalIndex.publish()
-            cur_tag = cache.get(MongoPortalIndex.portal_index_etag_cache_key)
+    def get_portal_index_etag(self):
+        """
+        The published etag, or None while it is unknown. A missing etag schedules a rebuild on the worker,
+        it is never published from here.
+        """
+        cur_tag = self.portal_index_etag
+        if cur_tag is None:
+            from discoverer.portalindex.scheduler import publish_scheduler
+            publish_scheduler.mark_dirty()
         return cur_tag
 
     def guid_index(self, publish_if_needed=True):
-        if self.guid_index_collection_name not in self.mongo.db.collection_names():
+        if not self.guid_index_published:
             self.publish_guid_index()
+        return self._read_guid_index()
+
+    def _read_guid_index(self):
         cursor = self.mongo.db[self.guid_index_collection_name]
-        idx = {r.get('guid'): r.get('_ref') for r in cursor.find()}
+        idx = {r.get('guid'): r.get('_ref') for r in cursor.find(projection={'guid': True, '_ref': True})}
         return idx
 
-    def cached_guid_index_json(self):
-        index_json = cache.get(self.portal_index_cache_key)
-        if not index_json:
-            self.publish()
-            return self._index_json
-        return index_json
+    @property
+    def tile_degrees(self):
+        return getattr(settings, 'PORTAL_INDEX_TILE_DEGREES', 1.0)
+
+    def tile_id(self, lat, lng):
+        return "{}_{}".format(int(math.floor(lat / self.tile_degrees)), int(math.floor(lng / self.tile_degrees)))
+
+    def _tile_cache_key(self, tile_id):
+        return "{}:tile:{}".format(self.portal_index_cache_key, tile_id)
+
+    def _read_guid_tiles(self):
+        tiles = {}
+        cursor = self.mongo.db[self.guid_index_collection_name].find(
+            projection={'guid': True, '_ref': True, 'location.coordinates': True})
+        for r in cursor:
+            coordinates = r.get('location', {}).get('coordinates')
+            if not coordinates:
+                # added incrementally since the last rebuild, it lands in its tile on the next one
+                continue
+            tiles.setdefault(self.tile_id(coordinates[1], coordinates[0]), {})[r.get('guid')] = r.get('_ref')
+        return tiles
+
+    def publish_tiles(self):
+        """
+        Publish the guid index split into a grid of PORTAL_INDEX_TILE_DEGREES tiles, each with an etag
+        derived from its content so a tile that didn't change keeps its etag across rebuilds.
+        """
+        seq = self.portal_index_seq
+        previous = cache.get(self.portal_index_tiles_cache_key) or {}
+        etags = {}
+        for tile_id, tile in self._read_guid_tiles().items():
+            tile_json = json.dumps(tile)
+            etags[tile_id] = sha1(tile_json).hexdigest()[:16]
+            self.index_cache.set(self._tile_cache_key(tile_id), tile_json, timeout=None)
+        cache.set(self.portal_index_tiles_cache_key, {'s': seq, 'g': self.tile_degrees, 'tiles': etags},
+                  timeout=None)
+        for tile_id in set(previous.get('tiles', {})) - set(etags):
+            self.index_cache.delete(self._tile_cache_key(tile_id))
+        return etags
+
+    def tiles_manifest(self):
+        """
+        The published tile manifest, empty while it isn't published, the rebuild runs on the worker.
+        """
+        manifest = cache.get(self.portal_index_tiles_cache_key)
+        if manifest is None:
+            from discoverer.portalindex.scheduler import publish_scheduler
+            publish_scheduler.mark_dirty()
+            return {}
+        return manifest
+
+    def tiles_etag(self, requested):
+        """
+        Etag of the tiles_json response for ``requested``, covering everything it carries:
+        the requested tiles, the sequence number and grid of the manifest and the search regions.
+        """
+        from discoverer.models import SearchRegion
+        manifest = self.tiles_manifest()
+        if 'tiles' not in manifest:
+            return None
+        etags = manifest['tiles']
+        parts = [u"s:{}".format(manifest.get('s', 0)), u"g:{}".format(manifest.get('g', self.tile_degrees)),
+                 u"r:{}".format(SearchRegion.objects.version())]
+        parts.extend(u"{}:{}:{}".format(tile_id, etags.get(tile_id), known_etag)
+                     for tile_id, known_etag in sorted(requested.items()))
+        return sha1(u",".join(parts).encode('utf-8')).hexdigest()
+
+    def tiles_json(self, requested):
+        """
+        Returns the tiles in ``requested``, a dict of tile id -> the etag the client holds or None.
+        Tiles the client already holds come back as just their etag, tiles without portals come back empty.
+        """
+        from discoverer.models import SearchRegion
+        manifest = self.tiles_manifest()
+        etags = manifest.get('tiles', {})
+        tiles = []
+        for tile_id, known_etag in sorted(requested.items()):
+            if 'tiles' not in manifest:
+                # not published yet, nothing can be told about any tile
+                break
+            etag = etags.get(tile_id)
+            if etag is None:
+                tile_json = '{}'
+            elif etag == known_etag:
+                tiles.append('{}: {{"e": {}}}'.format(json.dumps(tile_id), json.dumps(etag)))
+                continue
+            else:
+                tile_json = self.index_cache.get(self._tile_cache_key(tile_id))
+                if tile_json is None:
+                    # evicted, leave it out so the client asks again once the next rebuild has republished it
+                    from discoverer.portalindex.scheduler import publish_scheduler
+                    publish_scheduler.mark_dirty()
+                    continue
+            tiles.append('{}: {{"e": {}, "k": {}}}'.format(json.dumps(tile_id), json.dumps(etag), tile_json))
+        # tile bodies are already json, splice them in rather than decoding and encoding them again
+        return '{{"t": {{{}}}, "r": {}, "rs": {}, "s": {}, "g": {}}}'.format(
+            ", ".join(tiles),
+            json.dumps(SearchRegion.objects.get_active_coordinates()),
+            json.dumps(SearchRegion.objects.get_active_polygons()),
+            json.dumps(manifest.get('s', 0)),
+            json.dumps(manifest.get('g', self.tile_degrees)))
+
+    @property
+    def index_content_encodings(self):
+        return [encoding for encoding, encoder in INDEX_CONTENT_ENCODERS]
+
+    def _index_cache_key(self, encoding=None):
+        if encoding is None:
+            return self.portal_index_cache_key
+        return "{}:{}".format(self.portal_index_cache_key, encoding)
+
+    def cached_guid_index_json(self, encoding=None):
+        """
+        Returns the published index json, or its precomputed body for ``encoding``
+        (one of index_content_encodings), None while nothing has been published.
+        """
+        def load():
+            if encoding is None:
+                return self.index_cache.get(self.portal_index_cache_key)
+            return self.encoded_index_cache.get(self._index_cache_key(encoding))
+        return self._local_body(encoding, load)
+
+    def cached_guid_index_binary(self):
+        return self._local_body('bin', lambda: self.encoded_index_cache.get(self._index_cache_key('bin')))
+
+    def content_fingerprint(self, find_filter=None):
+        """
+        Digest of the portals matching ``find_filter``: their count and latest timestamp in each index tile.
+        Any portal added, removed or updated in the slice changes it, changes anywhere else don't.
+        """
+        tiles = self.portals.aggregate([
+            {"$match": find_filter or {}},
+            {"$group": {
+                '_id': {
+                    'lat': {"$floor": {"$divide": [{"$arrayElemAt": ['$location.coordinates', 1]}, self.tile_degrees]}},
+                    'lng': {"$floor": {"$divide": [{"$arrayElemAt": ['$location.coordinates', 0]}, self.tile_degrees]}},
+                },
+                'n': {"$sum": 1},
+                'timestamp': {"$max": '$timestamp'},
+            }},
+            {"$sort": {'_id.lat': 1, '_id.lng': 1}},
+        ], allowDiskUse=True)
+        digest = sha1()
+        for tile in tiles:
+            digest.update("{lat}_{lng}:{n}:{timestamp}|".format(n=tile['n'], timestamp=tile['timestamp'], **tile['_id']))
+        return digest.hexdigest()
 
     def intel_href(self, doc):
         return u"https://www.ingress.com/intel?ll={:.6f},{:.6f}&z=17".format(doc['location']['coordinates'][1],
@@ -185,6 +692,28 @@ class PortalIndexHelper(object):
     def latlngstr(self, latE6, lngE6):
         return u"{lat:.6f},{lng:.6f}".format(lat=latE6/1e6, lng=lngE6/1e6)
 
+    def _kml_placemark(self, portalinfo):
+        schema_data = [
+            KML_ElementMaker.SimpleData("{:.6f}".format(portalinfo['location']['coordinates'][0]), name="LNG"),
+            KML_ElementMaker.SimpleData("{:.6f}".format(portalinfo['location']['coordinates'][1]), name="LAT"),
+        ]
+        if 'region' in portalinfo:
+            schema_data.append(KML_ElementMaker.SimpleData(portalinfo['region'], name="REGION"))
+        if 'guid' in portalinfo:
+            schema_data.append(KML_ElementMaker.SimpleData(portalinfo['guid'], name="GUID"))
+
+        discovery_timestamp = discovered_at(portalinfo)
+
+        return KML_ElementMaker.Placemark(
+            KML_ElementMaker.name(portalinfo.get('name')),
+            KML_ElementMaker.description(self.intel_href(portalinfo)),
+            KML_ElementMaker.Point(
+                KML_ElementMaker.coordinates("{:.6f},{:.6f}".format(*portalinfo['location']['coordinates']))
+            ),
+            KML_ElementMaker.TimeStamp(KML_ElementMaker.when(discovery_timestamp.strftime('%Y-%m-%d'))),
+            KML_ElementMaker.ExtendedData(KML_ElementMaker.SchemaData(*schema_data, schemaUrl="#ip"))
+        )
+
     def generate_kml(self, filename='portals.kml', *args, **kwargs):
         kml_schema = KML_ElementMaker.Schema(
             KML_ElementMaker.SimpleField(name="LAT", type="float"),
@@ -194,68 +723,217 @@ class PortalIndexHelper(object):
             name="ingressportal",
             id="ip"
         )
-        kml_folder = KML_ElementMaker.Folder(
-            KML_ElementMaker.name(filename),
-        )
-        cursor = self.portals.find(*args, **kwargs)
-        for portalinfo in cursor:
-            schema_data = [
-                KML_ElementMaker.SimpleData("{:.6f}".format(portalinfo['location']['coordinates'][0]), name="LNG"),
-                KML_ElementMaker.SimpleData("{:.6f}".format(portalinfo['location']['coordinates'][1]), name="LAT"),
-            ]
-            if 'region' in portalinfo:
-                schema_data.append(KML_ElementMaker.SimpleData(portalinfo['region'], name="REGION"))
-            if 'guid' in portalinfo:
-                schema_data.append(KML_ElementMaker.SimpleData(portalinfo['guid'], name="GUID"))
-
-            discovery_timestamp = portalinfo['_history'][0]['timestamp']
-
-            placemark = KML_ElementMaker.Placemark(
-                KML_ElementMaker.name(portalinfo.get('name')),
-                KML_ElementMaker.description(self.intel_href(portalinfo)),
-                KML_ElementMaker.Point(
-                    KML_ElementMaker.coordinates("{:.6f},{:.6f}".format(*portalinfo['location']['coordinates']))
-                ),
-                KML_ElementMaker.TimeStamp(KML_ElementMaker.when(discovery_timestamp.strftime('%Y-%m-%d'))),
-                KML_ElementMaker.ExtendedData(KML_ElementMaker.SchemaData(*schema_data, schemaUrl="#ip"))
-            )
-            kml_folder.append(placemark)
 
-        doc = KML_ElementMaker.kml(
-            KML_ElementMaker.Document(
-                kml_schema,
-                kml_folder
-            )
-        )
-        kmlfile = ContentFile(etree.tostring(doc), name=filename)
-        return kmlfile
+        # write each placemark out as the cursor yields it instead of building the whole tree
+        kmlfile = tempfile.TemporaryFile()
+        kwargs.setdefault('projection', self.kml_projection)
+        kwargs.setdefault('batch_size', self.export_batch_size)
+        cursor = self.portals.find(*args, **kwargs)
+        with etree.xmlfile(kmlfile, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element(_kml_tag('kml'), nsmap={None: KML_NAMESPACE}):
+                with xf.element(_kml_tag('Document')):
+                    xf.write(kml_schema)
+                    with xf.element(_kml_tag('Folder')):
+                        xf.write(KML_ElementMaker.name(filename))
+                        for portalinfo in cursor:
+                            xf.write(self._kml_placemark(portalinfo))
+        kmlfile.seek(0)
+        return File(kmlfile, name=filename)
 
     def generate_csv(self, filename='portals.csv', csv_formatting_kwargs=None, *args, **kwargs):
         if csv_formatting_kwargs is None:
             csv_formatting_kwargs = {}
 
         fieldnames = ('guid', 'name', 'longitude', 'latitude', 'score_region', 'discovery_date')
-        buf = StringIO.StringIO()
-        csvwriter = csv.DictWriter(buf, fieldnames, extrasaction='ignore', **csv_formatting_kwargs)
+        # rows stay in memory up to the spool size and spill to disk beyond it
+        csvfile = tempfile.SpooledTemporaryFile(max_size=getattr(settings, 'DATASET_OUTPUT_SPOOL_MAX_SIZE', 5*1024*1024))
+        csvwriter = csv.DictWriter(csvfile, fieldnames, extrasaction='ignore', **csv_formatting_kwargs)
         csvwriter.writeheader()
 
         def _map_doc_to_csv(doc):
             return dict(
-                guid=doc['guid'],
-                name=doc['name'],
+                guid=doc['guid'].encode('utf-8'),
+                name=doc['name'].encode('utf-8'),
                 longitude=doc['location']['coordinates'][0],
                 latitude=doc['location']['coordinates'][1],
-                score_region=doc['region'],
-                discovery_date=doc['_history'][0]['timestamp'].strftime('%Y-%m-%d'),
+                score_region=doc['region'].encode('utf-8'),
+                discovery_date=discovered_at(doc).strftime('%Y-%m-%d'),
             )
 
+        kwargs.setdefault('projection', self.csv_projection)
+        kwargs.setdefault('batch_size', self.export_batch_size)
         cursor = self.portals.find(*args, **kwargs)
         for portalinfo in cursor:
             row = _map_doc_to_csv(portalinfo)
             csvwriter.writerow(row)
 
-        csvfile = ContentFile(buf.getvalue(), name=filename)
-        return csvfile
+        csvfile.seek(0)
+        return File(csvfile, name=filename)
+
+
+class PortalBatch(object):
+    """
+    Collects the portal upserts of one submission and writes them with a single unordered bulk_write.
+    Each request gets its own batch, repeated guids within it are collapsed to the last one submitted.
+    With a RegionIndex in ``regions`` portals are tagged with the search region they fall in,
+    and dropped when they fall in none and ``reject_outside`` is set.
+    """
+
+    def __init__(self, index, created_by=None, skip_unchanged=False, regions=None, reject_outside=False):
+        self.index = index
+        self.created_by = created_by
+        self.known_refs = index.known_refs() if skip_unchanged else None
+        self.regions = regions
+        self.reject_outside = reject_outside
+        self.skipped = 0
+        self.rejected = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def update_portal(self, latE6, lngE6, name, guid=None, timestamp=None, created_by=None, region=None):
+        if timestamp is None:
+            timestamp = timezone.now()
+        if created_by is None:
+            created_by = self.created_by
+
+        new_doc = {
+            'location': {
+                "type": "Point",
+                "coordinates": [lngE6/1e6, latE6/1e6]
+            },
+            'name': name,
+            'timestamp': timestamp,
+        }
+
+        or_operations = [{'guid': {"$exists": False}, 'location.coordinates': [lngE6/1e6, latE6/1e6]}]
+        if guid is not None:
+            or_operations.insert(0, {'guid': guid})
+            new_doc['guid'] = guid
+
+        new_doc['_ref'] = self.index.sha_hash(new_doc)
+        if self.known_refs is not None and guid is not None and self.known_refs.get(guid) == new_doc['_ref']:
+            # unchanged since the index was published, nothing to write
+            self.skipped += 1
+            return None
+
+        if created_by:
+            new_doc['reporter'] = created_by.username
+        if region:
+            new_doc['region'] = region
+
+        key = guid if guid is not None else tuple(new_doc['location']['coordinates'])
+        self._items.pop(key, None)
+        self._items[key] = (new_doc, {"$or": or_operations})
+        return new_doc
+
+    @staticmethod
+    def _discovered_fields(new_doc):
+        fields = {'discovered_at': new_doc['timestamp']}
+        if 'reporter' in new_doc:
+            fields['discovered_by'] = new_doc['reporter']
+        return fields
+
+    def operations(self):
+        """
+        Two operations per item: one that only matches when the stored _ref differs and appends to
+        the capped _history, and an upsert that only does anything when the portal is new.
+        """
+        max_history = self.index.portal_history_max_entries
+        operations = []
+        for new_doc, query in self._items.values():
+            operations.append(UpdateOne({"$and": [query, {"_ref": {"$ne": new_doc['_ref']}}]}, {
+                "$set": new_doc,
+                "$push": {
+                    "_history": {"$each": [new_doc], "$slice": -max_history}
+                }
+            }))
+            operations.append(UpdateOne(query, {
+                "$setOnInsert": dict(new_doc, _history=[new_doc], **self._discovered_fields(new_doc))
+            }, upsert=True))
+        return operations
+
+    def apply_regions(self):
+        if not self.regions:
+            return
+        keys = list(self._items.keys())
+        names = self.regions.point_in_regions(new_doc['location']['coordinates'] for new_doc, query in
+                                              self._items.values())
+        for key, name in zip(keys, names):
+            if name is not None:
+                self._items[key][0]['search_region'] = name
+            elif self.reject_outside:
+                del self._items[key]
+                self.rejected += 1
+
+    def stored_refs(self):
+        """
+        The _refs currently stored for the portals of this batch, read before it is written.
+        """
+        queries = [query for new_doc, query in self._items.values()]
+        return set(doc.get('_ref') for doc in self.index.portals.find({"$or": queries}, projection={'_ref': True}))
+
+    def execute(self, publish_changes=False):
+        self.apply_regions()
+        docs = [new_doc for new_doc, query in self._items.values()]
+        result = PortalBatchResult(docs, skipped=self.skipped, rejected=self.rejected)
+        if not docs:
+            return result
+
+        stored_refs = self.stored_refs()
+        try:
+            bulk_result = self.index.portals.bulk_write(self.operations(), ordered=False)
+        except BulkWriteError as e:
+            result.update_from_details(e.details)
+        else:
+            result.update_from_details(bulk_result.bulk_api_result)
+        # only new portals and changed _refs make history, a resubmitted unchanged portal matched nothing
+        self.index.archive_history([doc for doc, item in zip(docs, result.items)
+                                    if item['status'] != result.STATUS_ERROR and doc['_ref'] not in stored_refs])
+
+        self.index.counters.record(result)
+
+        if publish_changes:
+            self.index.publish_guid_index_changes(result.refs())
+        return result
+
+
+class PortalBatchResult(object):
+    STATUS_UPSERTED = 'upserted'
+    STATUS_UPDATED = 'updated'
+    STATUS_ERROR = 'error'
+
+    def __init__(self, docs, skipped=0, rejected=0):
+        self.docs = docs
+        self.items = [{'guid': doc.get('guid'), 'status': self.STATUS_UPDATED} for doc in docs]
+        self.discovered = 0
+        self.updated = 0
+        self.skipped = skipped
+        self.rejected = rejected
+
+    def update_from_details(self, details, operations_per_item=2):
+        self.discovered = details.get('nInserted', 0) + details.get('nUpserted', 0)
+        self.updated = details.get('nModified', 0)
+        for upserted in details.get('upserted', []):
+            self.items[upserted['index'] // operations_per_item].update(status=self.STATUS_UPSERTED,
+                                                                         _id=str(upserted['_id']))
+        for error in details.get('writeErrors', []):
+            self.items[error['index'] // operations_per_item].update(status=self.STATUS_ERROR,
+                                                                      error=error.get('errmsg'))
+
+    @property
+    def upserted_ids(self):
+        return [item['_id'] for item in self.items if item['status'] == self.STATUS_UPSERTED]
+
+    @property
+    def errors(self):
+        return [item for item in self.items if item['status'] == self.STATUS_ERROR]
+
+    def refs(self):
+        return {doc['guid']: doc['_ref'] for doc, item in zip(self.docs, self.items)
+                if 'guid' in doc and item['status'] != self.STATUS_ERROR}
 
 
 MongoPortalIndex = PortalIndexHelper()
@@ -0,0 +1,145 @@
+import datetime
+
+import pymongo
+from bson import ObjectId
+from pymongo import IndexModel
+
+
+# built in the background, they are created in the release phase while the old dynos keep serving
+PORTAL_INDEXES = {
+    'portals': [
+        IndexModel([('guid', pymongo.ASCENDING)], name='guid', background=True,
+                   partialFilterExpression={'guid': {'$exists': True}}),
+        # mongo partial indexes can't select on a missing field, so guid-less portals are looked up
+        # through a compound index where a missing guid is indexed as null
+        IndexModel([('location.coordinates', pymongo.ASCENDING), ('guid', pymongo.ASCENDING)],
+                   name='coordinates_guid', background=True),
+        IndexModel([('location', pymongo.GEOSPHERE)], name='location_2dsphere', background=True),
+        IndexModel([('discovered_at', pymongo.ASCENDING)], name='discovered_at', background=True),
+    ],
+    'portal_history': [
+        IndexModel([('_ref', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], name='_ref_timestamp',
+                   background=True, unique=True),
+        IndexModel([('guid', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)], name='guid_timestamp',
+                   background=True),
+    ],
+    'portals_guid_ref_map': [
+        IndexModel([('guid', pymongo.ASCENDING)], name='guid', background=True),
+    ],
+}
+
+# indexes replaced by one in PORTAL_INDEXES, dropped when the indexes are created
+RETIRED_INDEXES = {
+    # unique on _ref alone refused a portal returning to an earlier state
+    'portal_history': ['_ref'],
+}
+
+
+# representative shapes of the queries on the submission and publish paths, used for explain()
+HOT_QUERIES = [
+    ('update_portal', 'portals', {'$or': [
+        {'guid': '00000000000000000000000000000000.16'},
+        {'guid': {'$exists': False}, 'location.coordinates': [0.0, 0.0]},
+    ]}, None),
+    ('notify_channel_of_new_portals', 'portals', {'_id': {'$in': [ObjectId()]}}, None),
+    ('publish_guid_index', 'portals', {'guid': {'$exists': True}}, {'_ref': True, 'guid': True}),
+    ('publish_guid_index_changes', 'portals_guid_ref_map',
+     {'guid': {'$in': ['00000000000000000000000000000000.16']}}, None),
+    ('dataset_export', 'portals', {
+        'location': {'$geoWithin': {'$geometry': {
+            'type': 'Polygon', 'coordinates': [[[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 0.0]]]
+        }}},
+        'discovered_at': {'$gte': datetime.datetime(2016, 7, 19)},
+    }, None),
+]
+
+
+def _index_matches(index_model, info):
+    document = index_model.document
+    return (list(document['key'].items()) == list(info.get('key', [])) and
+            document.get('partialFilterExpression') == info.get('partialFilterExpression'))
+
+
+def verify_indexes(db, spec=None):
+    """
+    Compare the indexes in ``spec`` with the ones that exist.
+    Returns a list of (collection_name, index_name, status) where status is 'ok', 'missing' or 'different'.
+    """
+    if spec is None:
+        spec = PORTAL_INDEXES
+    report = []
+    for collection_name, index_models in spec.items():
+        existing = db[collection_name].index_information()
+        for index_model in index_models:
+            name = index_model.document['name']
+            if name not in existing:
+                status = 'missing'
+            elif not _index_matches(index_model, existing[name]):
+                status = 'different'
+            else:
+                status = 'ok'
+            report.append((collection_name, name, status))
+    return report
+
+
+def drop_retired_indexes(db, retired=None):
+    """
+    Drop the indexes in ``retired`` that still exist. Returns the (collection_name, index_name) pairs dropped.
+    """
+    if retired is None:
+        retired = RETIRED_INDEXES
+    dropped = []
+    for collection_name, index_names in retired.items():
+        existing = db[collection_name].index_information()
+        for index_name in index_names:
+            if index_name in existing:
+                db[collection_name].drop_index(index_name)
+                dropped.append((collection_name, index_name))
+    return dropped
+
+
+def ensure_indexes(db, spec=None):
+    """
+    Create any index in ``spec`` that doesn't exist yet, after dropping the retired ones it replaces.
+    Returns the (collection_name, index_name) pairs created.
+    """
+    if spec is None:
+        spec = PORTAL_INDEXES
+        drop_retired_indexes(db)
+    created = []
+    for collection_name, index_models in spec.items():
+        existing = db[collection_name].index_information()
+        missing = [index_model for index_model in index_models if index_model.document['name'] not in existing]
+        if missing:
+            db[collection_name].create_indexes(missing)
+            created.extend((collection_name, index_model.document['name']) for index_model in missing)
+    return created
+
+
+def _plan_stages(plan):
+    stages = []
+    while plan:
+        stage = plan.get('stage')
+        if plan.get('indexName'):
+            stage = "{}({})".format(stage, plan['indexName'])
+        stages.append(stage)
+        if 'inputStages' in plan:
+            for input_stage in plan['inputStages']:
+                stages.extend(_plan_stages(input_stage))
+            break
+        plan = plan.get('inputStage')
+    return stages
+
+
+def explain_hot_queries(db, queries=None):
+    """
+    Returns a list of (query_name, winning plan stages, uses_collscan) for each hot query.
+    """
+    if queries is None:
+        queries = HOT_QUERIES
+    plans = []
+    for name, collection_name, query, projection in queries:
+        explained = db[collection_name].find(query, projection).explain()
+        stages = _plan_stages(explained.get('queryPlanner', {}).get('winningPlan', {}))
+        plans.append((name, stages, 'COLLSCAN' in stages))
+    return plans
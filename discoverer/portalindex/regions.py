@@ -0,0 +1,76 @@
+from django.contrib.gis.geos import Point
+
+
+class RegionIndex(object):
+    """
+    The active search regions held in memory, for testing many points without a database round-trip.
+    Each region keeps its bounding box for a cheap first pass and a prepared geometry for the exact test.
+    """
+
+    def __init__(self, regions, simplify_tolerance=0.0):
+        """
+        ``regions`` is an iterable of (name, polygon) with polygons in lon/lat.
+        """
+        self.regions = []
+        self.extent = None
+        for name, geom in regions:
+            simplified = geom.simplify(simplify_tolerance, preserve_topology=True) if simplify_tolerance else geom
+            self.regions.append({
+                'name': name,
+                'extent': geom.extent,
+                'prepared': geom.prepared,
+                'coordinates': simplified.coords[0],
+                'geom': geom,
+            })
+            if self.extent is None:
+                self.extent = geom.extent
+            else:
+                self.extent = (min(self.extent[0], geom.extent[0]), min(self.extent[1], geom.extent[1]),
+                               max(self.extent[2], geom.extent[2]), max(self.extent[3], geom.extent[3]))
+
+    def __len__(self):
+        return len(self.regions)
+
+    @property
+    def names(self):
+        return [region['name'] for region in self.regions]
+
+    @property
+    def coordinates(self):
+        """
+        The simplified outer ring of each region, as sent to the plugin.
+        """
+        return [region['coordinates'] for region in self.regions]
+
+    def region_for(self, lng, lat):
+        """
+        Name of the first region containing the point, or None.
+        """
+        if self.extent is None:
+            return None
+        xmin, ymin, xmax, ymax = self.extent
+        if not (xmin <= lng <= xmax and ymin <= lat <= ymax):
+            # most points of a large import are nowhere near any region
+            return None
+        point = None
+        for region in self.regions:
+            xmin, ymin, xmax, ymax = region['extent']
+            if not (xmin <= lng <= xmax and ymin <= lat <= ymax):
+                continue
+            if point is None:
+                point = Point(lng, lat, srid=4326)
+            if region['prepared'].covers(point):
+                return region['name']
+        return None
+
+    def point_in_regions(self, points):
+        """
+        For each (lng, lat) in ``points``, the name of the first region containing it or None.
+        """
+        return [self.region_for(lng, lat) for lng, lat in points]
+
+    def covers(self, lng, lat):
+        """
+        True if the point is in any region, or if there are no regions to restrict to.
+        """
+        return not self.regions or self.region_for(lng, lat) is not None
@@ -0,0 +1,90 @@
+import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from discoverer.utils import acquire_lock, release_lock
+
+
+class PublishScheduler(object):
+    """
+    Coalesces "the index is dirty" signals into full guid index rebuilds.
+    A rebuild waits for ``debounce`` seconds of quiet and runs at most once per ``min_interval`` seconds,
+    but nothing marked dirty waits longer than ``max_delay`` seconds to be published.
+    """
+    dirty_since_cache_key = 'publishscheduler_dirty_since'
+    last_dirty_cache_key = 'publishscheduler_last_dirty'
+    last_published_cache_key = 'publishscheduler_last_published'
+    scheduled_lock_id = 'publish_guid_index'
+
+    @property
+    def min_interval(self):
+        return getattr(settings, 'PORTAL_INDEX_RECONCILE_SECONDS', 900)
+
+    @property
+    def debounce(self):
+        return getattr(settings, 'PORTAL_INDEX_PUBLISH_DEBOUNCE_SECONDS', 30)
+
+    @property
+    def max_delay(self):
+        return getattr(settings, 'PORTAL_INDEX_PUBLISH_MAX_DELAY', 1800)
+
+    @property
+    def pending(self):
+        return cache.get(self.dirty_since_cache_key) is not None
+
+    def state(self):
+        return {
+            'pending': self.pending,
+            'dirty_since': cache.get(self.dirty_since_cache_key),
+            'last_dirty': cache.get(self.last_dirty_cache_key),
+            'last_published': cache.get(self.last_published_cache_key),
+            'next_run_in': self.next_run_delay(),
+        }
+
+    def mark_dirty(self):
+        now = timezone.now()
+        cache.add(self.dirty_since_cache_key, now, timeout=None)
+        cache.set(self.last_dirty_cache_key, now, timeout=None)
+        self.schedule()
+
+    def next_run_delay(self, now=None):
+        """
+        Seconds until the next rebuild is due, 0 if it is due now, or None if nothing is pending.
+        """
+        dirty_since = cache.get(self.dirty_since_cache_key)
+        if dirty_since is None:
+            return None
+        if now is None:
+            now = timezone.now()
+
+        run_at = now
+        last_published = cache.get(self.last_published_cache_key)
+        if last_published is not None:
+            run_at = max(run_at, last_published + datetime.timedelta(seconds=self.min_interval))
+        last_dirty = cache.get(self.last_dirty_cache_key)
+        if last_dirty is not None:
+            run_at = max(run_at, last_dirty + datetime.timedelta(seconds=self.debounce))
+        run_at = min(run_at, dirty_since + datetime.timedelta(seconds=self.max_delay))
+        return max(0, int((run_at - now).total_seconds()))
+
+    def schedule(self):
+        from discoverer.tasks import publish_guid_index
+
+        delay = self.next_run_delay()
+        if delay is None:
+            return
+        if acquire_lock(self.scheduled_lock_id, ttl=delay + self.max_delay):
+            publish_guid_index.apply_async(countdown=delay)
+
+    def task_started(self):
+        release_lock(self.scheduled_lock_id)
+
+    def begin_publish(self):
+        # cleared before the rebuild reads anything, so signals arriving during it schedule another pass
+        cache.delete(self.dirty_since_cache_key)
+        cache.set(self.last_published_cache_key, timezone.now(), timeout=None)
+
+
+publish_scheduler = PublishScheduler()
@@ -130,6 +130,39 @@ if 'MEMCACHEDCLOUD_SERVERS' in os.environ:
 CELERY_BROKER_URL = os.environ.get('REDIS_URL')
 CELERY_RESULT_BACKEND = None
 
+# celery workers heartbeat into the cache, web processes only ask heroku for a worker when none is present
+CELERY_DYNO_BACKEND = os.environ.get('CELERY_DYNO_BACKEND', 'discoverer.utils.HerokuDynoBackend')
+CELERY_WORKER_PRESENCE_TIMEOUT = 11*60
+CELERY_DYNO_START_DEBOUNCE_SECONDS = 60
+
+# queue /spi submissions in redis and write them from a worker in merged batches
+PORTAL_INGEST_ASYNC = os.environ.get('PORTAL_INGEST_ASYNC', '').lower() in ('1', 'true', 'yes')
+PORTAL_INGEST_WINDOW_SECONDS = int(os.environ.get('PORTAL_INGEST_WINDOW_SECONDS', 5))
+PORTAL_INGEST_MAX_SUBMISSIONS = int(os.environ.get('PORTAL_INGEST_MAX_SUBMISSIONS', 200))
+
+# submissions are applied to the portal index incrementally, a full rebuild runs at most this often,
+# once submissions have been quiet for the debounce, and never later than the max delay after a change
+PORTAL_INDEX_RECONCILE_SECONDS = int(os.environ.get('PORTAL_INDEX_RECONCILE_SECONDS', 15*60))
+PORTAL_INDEX_PUBLISH_DEBOUNCE_SECONDS = int(os.environ.get('PORTAL_INDEX_PUBLISH_DEBOUNCE_SECONDS', 30))
+PORTAL_INDEX_PUBLISH_MAX_DELAY = int(os.environ.get('PORTAL_INDEX_PUBLISH_MAX_DELAY', 30*60))
+PORTAL_INDEX_LOCAL_PROBE_SECONDS = float(os.environ.get('PORTAL_INDEX_LOCAL_PROBE_SECONDS', 1))
+# guid log entries older than the published snapshot are kept this long for clients still holding an older one
+PORTAL_INDEX_LOG_RETENTION_SECONDS = int(os.environ.get('PORTAL_INDEX_LOG_RETENTION_SECONDS', 2*60*60))
+# the index is also published as a grid of tiles this many degrees on a side, clients fetch the ones they view
+PORTAL_INDEX_TILE_DEGREES = float(os.environ.get('PORTAL_INDEX_TILE_DEGREES', 1))
+PORTAL_INDEX_MAX_TILES_PER_REQUEST = int(os.environ.get('PORTAL_INDEX_MAX_TILES_PER_REQUEST', 64))
+
+# several search regions can be active, their outlines are simplified by this many degrees for the plugin
+SEARCH_REGION_SIMPLIFY_TOLERANCE = float(os.environ.get('SEARCH_REGION_SIMPLIFY_TOLERANCE', 0.0005))
+# submissions outside every active region are tagged with no search_region, or dropped when this is set
+SEARCH_REGION_REJECT_OUTSIDE = os.environ.get('SEARCH_REGION_REJECT_OUTSIDE', '').lower() in ('1', 'true', 'yes')
+
+# bulk imports hash _refs in chunks of this many portals per pool process
+PORTAL_REF_CHUNK_SIZE = int(os.environ.get('PORTAL_REF_CHUNK_SIZE', 10000))
+
+# portal documents embed this many of their latest history entries, the rest live in portal_history
+PORTAL_HISTORY_MAX_ENTRIES = int(os.environ.get('PORTAL_HISTORY_MAX_ENTRIES', 10))
+
 
 
 AUTH_USER_MODEL = 'discoverer.DiscovererUser'
@@ -220,6 +253,10 @@ STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 DEFAULT_FILE_STORAGE = 'storages.backends.dropbox.DropBoxStorage'
 DROPBOX_OAUTH2_TOKEN = os.environ.get('DROPBOX_OAUTH2_TOKEN', '')
 
+# dataset exports are spooled in memory up to this many bytes before spilling to a temp file
+DATASET_OUTPUT_SPOOL_MAX_SIZE = int(os.environ.get('DATASET_OUTPUT_SPOOL_MAX_SIZE', 5*1024*1024))
+DATASET_OUTPUT_CURSOR_BATCH_SIZE = int(os.environ.get('DATASET_OUTPUT_CURSOR_BATCH_SIZE', 1000))
+
 
 REST_FRAMEWORK = dict(
     DEFAULT_PERMISSION_CLASSES=[],
@@ -3,14 +3,19 @@ import datetime
 import os
 import requests
 from bson import ObjectId
+from django.conf import settings
+from django.db.models import F
 from django.utils import timezone
 
 from discoverer import celery_app
 from discoverer.celeryapp import close_worker_if_no_tasks_scheduled, get_last_task_time, \
-    heartbeat_idle_timeout, HEARTBEAT_PERIOD_MINUTES, HEARTBEAT_LOCK_KEY
-from discoverer.models import DatasetOutput
+    heartbeat_idle_timeout, HEARTBEAT_PERIOD_MINUTES, HEARTBEAT_LOCK_KEY, HEARTBEAT_LOCK_TTL
+from discoverer.ingest import claim_submissions, ack_submissions, requeue_unacked_submissions, merge_submissions, \
+    queued_submission_count
+from discoverer.models import DatasetOutput, DiscovererUser
 from discoverer.portalindex.helpers import MongoPortalIndex
-from discoverer.utils import acquire_lock, release_lock
+from discoverer.portalindex.scheduler import publish_scheduler
+from discoverer.utils import acquire_lock, release_lock, renew_lock, publish_worker_presence, CacheLock
 
 
 @celery_app.task(bind=True)
@@ -21,6 +26,8 @@ def heartbeat_idle_check(self, idle_timeout_minutes=HEARTBEAT_PERIOD_MINUTES):
         release_lock(HEARTBEAT_LOCK_KEY)
         close_worker_if_no_tasks_scheduled(worker_hostname=self.request.hostname)
     else:
+        publish_worker_presence(hostname=self.request.hostname)
+        renew_lock(HEARTBEAT_LOCK_KEY, ttl=HEARTBEAT_LOCK_TTL)
         heartbeat_idle_check.apply_async(eta=now+datetime.timedelta(minutes=HEARTBEAT_PERIOD_MINUTES),
                                          kwargs=dict(idle_timeout_minutes=idle_timeout_minutes))
 
@@ -30,24 +37,90 @@ def heartbeat_idle_check(self, idle_timeout_minutes=HEARTBEAT_PERIOD_MINUTES):
 def regenerate_dataset_output(self, dataset_output_pk, force=False):
     lock_id = "generate_dataset_output:{}".format(dataset_output_pk)
 
-    if acquire_lock(lock_id):
-        try:
+    with CacheLock(lock_id, ttl=getattr(settings, 'DATASET_OUTPUT_LOCK_TTL', 30*60)) as lock:
+        if lock.acquired:
             dataset = DatasetOutput.objects.get(pk=dataset_output_pk)
             dataset.regenerate(force=force)
-        except Exception as e:
-            raise
-        finally:
-            release_lock(lock_id)
 
 
-publish_guid_index_lock_key = "publish_guid_index"
+@celery_app.task(bind=True)
+@heartbeat_idle_timeout
+def publish_guid_index(self, force=False):
+    publish_scheduler.task_started()
+    delay = publish_scheduler.next_run_delay()
+    if not force and delay is None:
+        return
+    if not force and delay > 0:
+        # more signals arrived since this run was scheduled, wait out the debounce
+        publish_scheduler.schedule()
+        return
+
+    # keeps a second worker from running the same rebuild concurrently
+    with CacheLock("publish_guid_index:running", ttl=getattr(settings, 'PORTAL_INDEX_PUBLISH_LOCK_TTL', 15*60)) as lock:
+        if lock.acquired:
+            publish_scheduler.begin_publish()
+            MongoPortalIndex.publish_guid_index()
+            MongoPortalIndex.counters.reconcile()
+            DatasetOutput.objects.refresh_fingerprints()
+    publish_scheduler.schedule()
+
+
+def schedule_index_followups(results):
+    """
+    Follow-up work once a batch of submissions is written: schedule the index reconciliation and announce new portals.
+    """
+    if results.discovered + results.updated > 0:
+        # the index was updated incrementally, the full rebuild is only a periodic reconciliation
+        publish_scheduler.mark_dirty()
+        upserted_ids = results.upserted_ids
+        if os.environ.get('GROUPME_BOT_ID', False) and len(upserted_ids) > 0:
+            notify_channel_of_new_portals.apply_async(kwargs=dict(new_doc_ids=upserted_ids))
+
+
+drain_ingest_queue_lock_key = "drain_ingest_queue"
+
+
+def schedule_ingest_drain(countdown=None):
+    if countdown is None:
+        countdown = getattr(settings, 'PORTAL_INGEST_WINDOW_SECONDS', 5)
+    if acquire_lock(drain_ingest_queue_lock_key, ttl=countdown + 60):
+        drain_ingest_queue.apply_async(countdown=countdown)
 
 
 @celery_app.task(bind=True)
 @heartbeat_idle_timeout
-def publish_guid_index(self):
-    release_lock(publish_guid_index_lock_key)
-    MongoPortalIndex.publish_guid_index()
+def drain_ingest_queue(self):
+    release_lock(drain_ingest_queue_lock_key)
+
+    # one drainer at a time, so whatever is still in the processing list was left by one that died
+    with CacheLock("drain_ingest_queue:running", ttl=getattr(settings, 'PORTAL_INGEST_DRAIN_LOCK_TTL', 10*60)) as lock:
+        if not lock.acquired:
+            schedule_ingest_drain()
+            return
+        requeue_unacked_submissions()
+
+        payloads = claim_submissions(getattr(settings, 'PORTAL_INGEST_MAX_SUBMISSIONS', 200))
+        if payloads:
+            merged = merge_submissions(payloads)
+            users = DiscovererUser.objects.in_bulk(set(user_id for user_id, submitted_at, item in merged))
+            # one batch per user, so each user is credited with what the write actually changed
+            batches = {}
+            for user_id, submitted_at, item in merged:
+                if user_id not in batches:
+                    batches[user_id] = MongoPortalIndex.batch(created_by=users.get(user_id), skip_unchanged=True,
+                                                              check_regions=True)
+                batches[user_id].update_portal(timestamp=submitted_at, **item)
+            for user_id, batch in batches.items():
+                results = batch.execute(publish_changes=True)
+                if user_id in users and results.discovered + results.updated > 0:
+                    DiscovererUser.objects.filter(pk=user_id).update(
+                        discovered_count=F('discovered_count') + results.discovered,
+                        updated_count=F('updated_count') + results.updated)
+                schedule_index_followups(results)
+            ack_submissions(payloads)
+
+    if queued_submission_count() > 0:
+        schedule_ingest_drain(countdown=0)
 
 
 @celery_app.task(bind=True)
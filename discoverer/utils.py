@@ -1,3 +1,5 @@
+import threading
+import uuid
 from collections import OrderedDict
 
 import heroku3
@@ -7,6 +9,7 @@ from django.core.cache import cache
 from hashlib import md5
 
 from django.utils import timezone
+from django.utils.module_loading import import_string
 from geopy.geocoders import Nominatim
 from requests import HTTPError
 
@@ -24,9 +27,6 @@ _heroku_dyno_cache_key = "HEROKU_CELERY_WORKER_DYNO_ID"
 
 
 def active_celery_dyno(*args, **kwargs):
-    if getattr(settings, 'MOCK_CELERY_DYNO', False):
-        return
-
     app = heroku_app(*args, **kwargs)
     dyno_id = cache.get(_heroku_dyno_cache_key)
     if dyno_id is not None:
@@ -57,29 +57,129 @@ def heroku_app(api_key=None, app_name=None):
     return heroku_app
 
 
+class HerokuDynoBackend(object):
+    """
+    Runs the celery worker as a detached one-off heroku dyno.
+    """
+    worker_command = 'celery worker --app=discoverer.celery_app -l info --concurrency 1'
+
+    def active_dyno(self, *args, **kwargs):
+        return active_celery_dyno(*args, **kwargs)
+
+    def start(self, *args, **kwargs):
+        dyno = self.active_dyno(*args, **kwargs)
+        if dyno is None:
+            app = heroku_app(*args, **kwargs)
+            try:
+                dyno = app.run_command_detached(self.worker_command)
+            except HTTPError as e:
+                pass
+            else:
+                cache.set(_heroku_dyno_cache_key, dyno.id)
+
+    def kill(self, *args, **kwargs):
+        dyno = self.active_dyno(*args, **kwargs)
+        if dyno is not None:
+            dyno.kill()
+            cache.delete(_heroku_dyno_cache_key)
+
+
+class LocalDynoBackend(object):
+    """
+    Stand-in for local development and tests, records what would have been asked of heroku.
+    """
+
+    def __init__(self):
+        self.started = 0
+        self.killed = 0
+
+    def active_dyno(self, *args, **kwargs):
+        return None
+
+    def start(self, *args, **kwargs):
+        self.started += 1
+
+    def kill(self, *args, **kwargs):
+        self.killed += 1
+
+
+_dyno_backend = None
+
+
+def dyno_backend():
+    global _dyno_backend
+    if _dyno_backend is None:
+        if getattr(settings, 'MOCK_CELERY_DYNO', False):
+            backend_path = 'discoverer.utils.LocalDynoBackend'
+        else:
+            backend_path = getattr(settings, 'CELERY_DYNO_BACKEND', 'discoverer.utils.HerokuDynoBackend')
+        _dyno_backend = import_string(backend_path)()
+    return _dyno_backend
+
+
+WORKER_PRESENCE_KEY = "discoverer:celery_worker:presence"
+_start_celery_dyno_debounce_key = "discoverer:celery_worker:start_requested"
+
+
+def publish_worker_presence(hostname=None):
+    cache.set(WORKER_PRESENCE_KEY, {'hostname': hostname, 'timestamp': timezone.now()},
+              timeout=getattr(settings, 'CELERY_WORKER_PRESENCE_TIMEOUT', 11*60))
+
+
+def clear_worker_presence():
+    cache.delete(WORKER_PRESENCE_KEY)
+
+
+def worker_is_present():
+    return cache.get(WORKER_PRESENCE_KEY) is not None
+
+
 def start_celery_dyno(*args, **kwargs):
-    if getattr(settings, 'MOCK_CELERY_DYNO', False):
+    """
+    Make sure a celery worker is coming up without holding up the caller.
+    Workers heartbeat into the cache, so when one is present this is a single cache read; otherwise the
+    start is debounced across web processes and the heroku api calls happen on a background thread.
+    """
+    if worker_is_present():
+        return
+    if not cache.add(_start_celery_dyno_debounce_key, timezone.now(),
+                     timeout=getattr(settings, 'CELERY_DYNO_START_DEBOUNCE_SECONDS', 60)):
         return
 
-    dyno = active_celery_dyno(*args, **kwargs)
-    if dyno is None:
-        app = heroku_app(*args, **kwargs)
-        try:
-            dyno = app.run_command_detached('celery worker --app=discoverer.celery_app -l info --concurrency 1')
-        except HTTPError as e:
-            pass
-        else:
-            cache.set(_heroku_dyno_cache_key, dyno.id)
+    thread = threading.Thread(target=dyno_backend().start, args=args, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
 
 
 def kill_celery_dyno(*args, **kwargs):
-    if getattr(settings, 'MOCK_CELERY_DYNO', False):
-        return
+    clear_worker_presence()
+    dyno_backend().kill(*args, **kwargs)
+
+
+def preferred_content_encoding(accept_encoding, available):
+    """
+    Pick the first of ``available`` encodings the Accept-Encoding header allows, or None for identity.
+    """
+    accepted = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        coding = params[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
 
-    dyno = active_celery_dyno(*args, **kwargs)
-    if dyno is not None:
-        dyno.kill()
-        cache.delete(_heroku_dyno_cache_key)
+    for coding in available:
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
 
 
 def ordered_dict_hash(d):
@@ -97,14 +197,74 @@ def is_locked(lock_id):
     return False if cache.get(_lock_key(lock_id)) is None else True
 
 
-def acquire_lock(lock_id):
-    if not is_locked(lock_id):
-        lock = timezone.now()
-        cache.set(_lock_key(lock_id), lock)
-        return True
+class CacheLock(object):
+    """
+    Distributed lock on the shared cache. Taken with an atomic cache.add, so only one process can win it,
+    and it expires after ``ttl`` seconds so a crashed holder can't keep it forever.
+    Each instance carries an owner token and only releases or renews the lock while it still holds it.
+    """
+
+    def __init__(self, lock_id, ttl=None):
+        self.lock_id = lock_id
+        self.key = _lock_key(lock_id)
+        self.ttl = ttl if ttl is not None else getattr(settings, 'DISCOVERER_LOCK_TTL', 60*60)
+        self.token = uuid.uuid4().hex
+        self.acquired = False
+
+    def acquire(self):
+        self.acquired = cache.add(self.key, self.token, timeout=self.ttl)
+        return self.acquired
+
+    @property
+    def owned(self):
+        return cache.get(self.key) == self.token
+
+    def renew(self, ttl=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if self.owned:
+            cache.set(self.key, self.token, timeout=self.ttl)
+            return True
+        return False
+
+    def release(self):
+        # get-then-delete isn't atomic on memcached, the window is only open if the ttl runs out right here
+        if self.owned:
+            cache.delete(self.key)
+            self.acquired = False
+            return True
+        return False
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.acquired:
+            self.release()
+
+
+def acquire_lock(lock_id, ttl=None):
+    """
+    Returns the held CacheLock, or False if someone else holds ``lock_id``.
+    """
+    lock = CacheLock(lock_id, ttl=ttl)
+    if lock.acquire():
+        return lock
     return False
 
 
+def renew_lock(lock_id, ttl=None):
+    """
+    Extend ``lock_id`` whoever holds it, for locks used as "already scheduled" flags.
+    """
+    cache.set(_lock_key(lock_id), timezone.now(),
+              timeout=ttl if ttl is not None else getattr(settings, 'DISCOVERER_LOCK_TTL', 60*60))
+
+
 def release_lock(lock_id):
+    """
+    Release ``lock_id`` whoever holds it, for locks used as "already scheduled" flags.
+    """
     cache.delete(_lock_key(lock_id))
 
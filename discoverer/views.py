@@ -1,30 +1,32 @@
 import datetime
 import os
+import re
 from celery.exceptions import TimeoutError
 from celery.result import AsyncResult
 from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.contrib.sites.models import Site
-from django.http import Http404, StreamingHttpResponse, HttpResponse, HttpResponseRedirect
+from django.http import Http404, StreamingHttpResponse, HttpResponse, HttpResponseRedirect, HttpResponseBadRequest
 from django.urls import reverse_lazy
+from django.utils.cache import patch_vary_headers
 from django.utils.decorators import method_decorator
 from django.views import View
 from django.views.decorators.http import last_modified, etag
 from django.views.generic import TemplateView, FormView, CreateView, ListView, RedirectView
 from django.views.generic.detail import SingleObjectMixin
-from pymongo.errors import BulkWriteError
 from rest_framework import permissions, serializers
 from rest_framework.response import Response
-from rest_framework.status import HTTP_401_UNAUTHORIZED, HTTP_400_BAD_REQUEST
+from rest_framework.status import HTTP_401_UNAUTHORIZED, HTTP_400_BAD_REQUEST, HTTP_202_ACCEPTED
 from rest_framework.views import APIView
 
 from discoverer.forms import ExportDatasetForm
+from discoverer.ingest import ingest_async_enabled, enqueue_submission
 from discoverer.models import SearchRegion, DatasetOutput
 from discoverer.portalindex.helpers import MongoPortalIndex
-from discoverer.utils import start_celery_dyno, ordered_dict_hash, acquire_lock
-from discoverer.tasks import publish_guid_index, notify_channel_of_new_portals, regenerate_dataset_output, \
-    publish_guid_index_lock_key
+from discoverer.portalindex.scheduler import publish_scheduler
+from discoverer.utils import start_celery_dyno, ordered_dict_hash, preferred_content_encoding
+from discoverer.tasks import regenerate_dataset_output, schedule_index_followups, schedule_ingest_drain
 
 
 @method_decorator(login_required, name='dispatch')
@@ -37,6 +39,7 @@ class Home(TemplateView):
                                    self.request.user.has_perm('discoverer.read_iitcplugin')
         context['site'] = Site.objects.get_current(request=self.request)
         context['portal_index_count'] = MongoPortalIndex.portal_index_count
+        context['portal_index_publish_pending'] = publish_scheduler.pending
         return context
 
 
@@ -70,8 +73,52 @@ def _portal_index_last_modified(*args, **kwargs):
     return MongoPortalIndex.portal_index_last_modified
 
 
-def _portal_index_etag(*args, **kwargs):
-    return MongoPortalIndex.portal_index_etag
+_tile_id_re = re.compile(r'^-?\d+_-?\d+$')
+
+
+def _requested_tiles(request):
+    """
+    Parse ?tiles=<tile id>[:<etag>],... into a dict of tile id -> etag, raises ValueError if it is malformed.
+    """
+    requested = {}
+    for tile in request.GET.get('tiles', '').split(','):
+        tile_id, _, etag = tile.strip().partition(':')
+        if not _tile_id_re.match(tile_id):
+            raise ValueError("invalid tile {}".format(tile_id))
+        requested[tile_id] = etag or None
+    if len(requested) > getattr(settings, 'PORTAL_INDEX_MAX_TILES_PER_REQUEST', 64):
+        raise ValueError("too many tiles")
+    return requested
+
+
+def _portal_index_etag(request, *args, **kwargs):
+    if 'tiles' in request.GET:
+        try:
+            return MongoPortalIndex.tiles_etag(_requested_tiles(request))
+        except ValueError:
+            return None
+    etag = MongoPortalIndex.portal_index_etag
+    if etag is None:
+        return etag
+    # each representation of the snapshot needs its own strong etag, ?since= included
+    # as it falls back to the encoded snapshot when the log doesn't reach back far enough
+    if request.GET.get('format', None) == 'bin' and 'since' not in request.GET:
+        return "{}-bin".format(etag)
+    encoding = _index_content_encoding(request)
+    return "{}-{}".format(etag, encoding) if encoding is not None else etag
+
+
+def _index_content_encoding(request):
+    return preferred_content_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''),
+                                      MongoPortalIndex.index_content_encodings)
+
+
+def _index_unavailable():
+    # the index is being rebuilt on the worker, it is never published from a request
+    response = HttpResponse("portal index is being published, retry shortly", status=503,
+                            content_type='text/plain')
+    response['Retry-After'] = getattr(settings, 'PORTAL_INDEX_PUBLISH_DEBOUNCE_SECONDS', 30)
+    return response
 
 
 @method_decorator(etag(_portal_index_etag), name='dispatch')
@@ -83,7 +130,40 @@ class ServeIndex(PermissionRequiredMixin, View):
     http_method_names = ('get',)
 
     def get(self, request, *args, **kwargs):
-        response = HttpResponse(MongoPortalIndex.cached_guid_index_json())
+        index_json = None
+        encoding = None
+        since = request.GET.get('since', None)
+        if 'tiles' in request.GET:
+            try:
+                index_json = MongoPortalIndex.tiles_json(_requested_tiles(request))
+            except ValueError as e:
+                return HttpResponseBadRequest(str(e))
+        elif since is not None:
+            try:
+                index_json = MongoPortalIndex.index_changes_json(int(since))
+            except ValueError:
+                return HttpResponseBadRequest("invalid since")
+        elif request.GET.get('format', None) == 'bin':
+            index_bin = MongoPortalIndex.cached_guid_index_binary()
+            if index_bin is None:
+                return _index_unavailable()
+            response = HttpResponse(index_bin)
+            response['Content-Length'] = len(index_bin)
+            response['Cache-Control'] = 'public,max-age=60'
+            response['Content-Type'] = 'application/octet-stream'
+            return response
+
+        if index_json is None:
+            encoding = _index_content_encoding(request)
+            index_json = MongoPortalIndex.cached_guid_index_json(encoding=encoding)
+            if index_json is None:
+                return _index_unavailable()
+
+        response = HttpResponse(index_json)
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        response['Content-Length'] = len(index_json)
         response['Cache-Control'] = 'public,max-age=60'
         response['Content-Type'] = 'application/json'
         return response
@@ -125,7 +205,8 @@ class PortalInfoSerializer(serializers.Serializer):
     region = serializers.CharField()
 
     def create(self, validated_data):
-        MongoPortalIndex.update_portal(**validated_data)
+        batch = validated_data.pop('batch')
+        batch.update_portal(**validated_data)
         return validated_data
 
 
@@ -136,31 +217,43 @@ class SubmitPortalInfos(APIView):
         if not request.user.has_perm('discoverer.add_portalinfo'):
             return Response(status=HTTP_401_UNAUTHORIZED)
 
-        # TODO: filter request.data where _ref matches index
         serializer = PortalInfoSerializer(data=request.data, many=True)
         serializer.is_valid(raise_exception=True)
-        serializer.save(created_by=request.user)
-        try:
-            results = MongoPortalIndex.bulk_op_execute()
-        except BulkWriteError as e:
-            return Response(e.details, status=HTTP_400_BAD_REQUEST)
 
-        discovered = results.get('nInserted', 0) + results.get('nUpserted', 0)
-        updated = results.get('nModified', 0)
+        if ingest_async_enabled():
+            ticket = enqueue_submission(request.user, serializer.validated_data)
+            schedule_ingest_drain()
+            start_celery_dyno()
+            return Response({
+                'ticket': ticket,
+                'queued': len(serializer.validated_data),
+            }, status=HTTP_202_ACCEPTED)
+
+        # portals whose _ref matches the published index are dropped before anything is written
+        batch = MongoPortalIndex.batch(created_by=request.user, skip_unchanged=True, check_regions=True)
+        serializer.save(batch=batch, created_by=request.user)
+        results = batch.execute(publish_changes=True)
+        if len(batch) > 0 and len(results.errors) == len(batch):
+            return Response(results.errors, status=HTTP_400_BAD_REQUEST)
+
+        discovered = results.discovered
+        updated = results.updated
 
         if discovered + updated > 0:
             request.user.discovered_count += discovered
             request.user.updated_count += updated
             request.user.save()
 
-            if acquire_lock(publish_guid_index_lock_key):
-                publish_guid_index.apply_async()
-            upserted_ids = list(map(lambda r: str(r.get('_id')), results.get('upserted', [])))
-            if os.environ.get('GROUPME_BOT_ID', False) and len(upserted_ids) > 0:
-                notify_channel_of_new_portals.apply_async(kwargs=dict(new_doc_ids=upserted_ids))
+            schedule_index_followups(results)
             start_celery_dyno()
 
-        return Response("ok")
+        return Response({
+            'discovered': discovered,
+            'updated': updated,
+            'skipped': results.skipped,
+            'rejected': results.rejected,
+            'errors': results.errors,
+        })
 
 
 @method_decorator(permission_required('discoverer.has_kml_download_perm'), name='dispatch')
@@ -199,33 +292,39 @@ class DatasetCreate(CreateView):
         return context
 
     def form_valid(self, form):
+        discovered_after = form.cleaned_data.get('discovered_after')
         config_kwargs = dict(
             filetype=form.data.get('filetype', 'kml'),
-            discovered_after=form.data.get('discovered_after', None),
-            range=form.data.get('range')
+            discovered_after=discovered_after.isoformat() if discovered_after else None,
+            range=form.cleaned_data['range'].geojson
         )
         if config_kwargs['filetype'] == 'csv':
             config_kwargs['options'] = form.get_csv_formatting_kwargs()
         config_hash = ordered_dict_hash(config_kwargs)
 
-        self.object, created = DatasetOutput.objects.get_or_create(
-            filetype=config_kwargs['filetype'],
-            portal_index_etag=MongoPortalIndex.get_portal_index_etag(),
-            config_hash=config_hash,
-            defaults=dict(
-                name=form.data.get('name'),
+        # one dataset per name and config, kept fresh by its content fingerprint rather than recreated per
+        # index etag, datasets of other names with the same content share its file
+        name = form.data.get('name')
+        self.object = DatasetOutput.objects.filter(config_hash=config_hash, name=name).first()
+        created = self.object is None
+        if created:
+            self.object = DatasetOutput.objects.create(
+                filetype=config_kwargs['filetype'],
+                portal_index_etag=MongoPortalIndex.get_portal_index_etag() or '',
+                config_hash=config_hash,
+                name=name,
                 config_kwargs=config_kwargs
             )
-        )
-        if created or self.object.status != DatasetOutput.STATUS_READY:
+        if created or self.object.get_status() != DatasetOutput.STATUS_READY:
             regenerate_dataset_output.apply_async(kwargs=dict(dataset_output_pk=self.object.pk))
             start_celery_dyno()
         return HttpResponseRedirect(self.get_success_url())
 
     def get_form_kwargs(self):
         kwargs = super(DatasetCreate, self).get_form_kwargs()
+        active = SearchRegion.objects.get_active()
         kwargs['initial'] = {
-            'range': SearchRegion.objects.get_active().geom,
+            'range': active.geom if active else None,
             'csv_delimiter': ',',
             'csv_quotechar': '"',
             'csv_lineterminator': "\\r\\n",
@@ -2,7 +2,7 @@
 // @id             iitc-plugin-portal-discoverer@nobody889
 // @name           IITC plugin: Portal Discoverer
 // @category       Cache
-// @version        2.0.5
+// @version        2.4.1
 // @namespace      https://github.com/jonatkins/ingress-intel-total-conversion
 // @description    [iitc-2017-01-08-021732] discover portals
 // @include        https://*.ingress.com/intel*
@@ -26,6 +26,16 @@ function wrapper(plugin_info) {
     window.plugin.portalDiscoverer = function() {};
     window.plugin.portalDiscoverer.portalQueue = []; // portals found before we got index
     window.plugin.portalDiscoverer.portalIndex = undefined; // portals we get back from server
+    window.plugin.portalDiscoverer.portalIndexSeq = undefined; // sequence number of the index we hold
+    window.plugin.portalDiscoverer.portalIndexBin = undefined; // binary snapshot, portalIndex holds changes on top of it
+    window.plugin.portalDiscoverer.use_binary_index = true;
+    window.plugin.portalDiscoverer.use_tiled_index = true;
+    window.plugin.portalDiscoverer.tile_degrees = 1; // the server's grid, corrected from its responses
+    window.plugin.portalDiscoverer.max_tiles_per_request = 64;
+    window.plugin.portalDiscoverer.portalIndexTiles = {}; // tile id -> etag of the tiles we hold
+    window.plugin.portalDiscoverer.tilesRequested = {}; // tile id -> when we last asked for it
+    window.plugin.portalDiscoverer.portalIndexComplete = false; // holding a full snapshot rather than tiles
+    window.plugin.portalDiscoverer.index_refresh_minutes = 5;
     window.plugin.portalDiscoverer.newPortals = {}; // portals we've seen that dont match index
 
     window.plugin.portalDiscoverer.base_url = undefined;
@@ -35,7 +45,7 @@ function wrapper(plugin_info) {
     window.plugin.portalDiscoverer.highlightedPortals = {};
 
     window.plugin.portalDiscoverer.highlightQueue = [];
-    window.plugin.portalDiscoverer.filter_bounds = undefined;
+    window.plugin.portalDiscoverer.filter_bounds = undefined; // outer rings of the active search regions
 
     window.plugin.portalDiscoverer.setup = function() {
 
@@ -44,6 +54,8 @@ function wrapper(plugin_info) {
             window.plugin.portalDiscoverer.base_url = base_url;
             window.plugin.portalDiscoverer.fetchIndex();
         }
+        setInterval(window.plugin.portalDiscoverer.fetchIndex, window.plugin.portalDiscoverer.index_refresh_minutes*60*1000);
+        window.map.on('moveend', window.plugin.portalDiscoverer.fetchTiles);
 
         addHook('portalAdded', window.plugin.portalDiscoverer.handlePortalAdded);
 
@@ -62,18 +74,17 @@ function wrapper(plugin_info) {
         var ll = _llstring(latlng);
         var guid = data.portal.options.guid;
 
-        if (!window.plugin.portalDiscoverer.portalIndex) {
+        if (!window.plugin.portalDiscoverer.portalIndex || !_tile_loaded(latlng)) {
             window.plugin.portalDiscoverer.highlightQueue.push(data);
             return;
         }
 
-        if (window.plugin.portalDiscoverer.filter_bounds &&
-            !_point_in_polygon([data.portal._latlng.lng, data.portal._latlng.lat], window.plugin.portalDiscoverer.filter_bounds)) {
+        if (!_point_in_regions([data.portal._latlng.lng, data.portal._latlng.lat], window.plugin.portalDiscoverer.filter_bounds)) {
 //            console.log("discoverer highlight skipping out of bounds", window.plugin.portalDiscoverer.filter_bounds )
             return;
         }
 
-        if (!(guid in window.plugin.portalDiscoverer.portalIndex)) {
+        if (_index_get(guid) === undefined) {
 
             window.plugin.portalDiscoverer.highlightedPortals[guid] = {
                 portal: data.portal,
@@ -96,7 +107,7 @@ function wrapper(plugin_info) {
         var html = $('<div/>');
         if (window.plugin.portalDiscoverer.base_url) {
             var stats = $('<p class="stats"></p>');
-            stats.append($('<span>Index: ' + (window.plugin.portalDiscoverer.portalIndex ? Object.keys(window.plugin.portalDiscoverer.portalIndex).length : "-") + '</span>'));
+            stats.append($('<span>Index: ' + (window.plugin.portalDiscoverer.portalIndex ? _index_size() : "-") + '</span>'));
             stats.append($('<span>Discovered: ' + window.plugin.portalDiscoverer.discovered_count + '</span>'));
             stats.append($('<span>Queued: ' + Object.keys(window.plugin.portalDiscoverer.newPortals).length + '</span>'));
 
@@ -109,6 +120,11 @@ function wrapper(plugin_info) {
             }));
             html.append($('<button style="margin-left: 1em">Refresh Index</button>').click(function() {
                 window.plugin.portalDiscoverer.portalIndex = undefined;
+                window.plugin.portalDiscoverer.portalIndexSeq = undefined;
+                window.plugin.portalDiscoverer.portalIndexBin = undefined;
+                window.plugin.portalDiscoverer.portalIndexTiles = {};
+                window.plugin.portalDiscoverer.tilesRequested = {};
+                window.plugin.portalDiscoverer.portalIndexComplete = false;
                 window.plugin.portalDiscoverer.fetchIndex();
             }));
         } else {
@@ -145,14 +161,14 @@ function wrapper(plugin_info) {
         var ll = [data.portal._latlng.lat, data.portal._latlng.lng];
 
 
-        if (!window.plugin.portalDiscoverer.portalIndex) {
+        if (!window.plugin.portalDiscoverer.portalIndex || !_tile_loaded(ll)) {
             window.plugin.portalDiscoverer.portalQueue.push(data);
 //            console.log("discoverer addPortal pushing to queue")
+            window.plugin.portalDiscoverer.fetchTiles();
             return;
         }
 
-        if (window.plugin.portalDiscoverer.filter_bounds &&
-            !_point_in_polygon([data.portal._latlng.lng, data.portal._latlng.lat], window.plugin.portalDiscoverer.filter_bounds)) {
+        if (!_point_in_regions([data.portal._latlng.lng, data.portal._latlng.lat], window.plugin.portalDiscoverer.filter_bounds)) {
 //            console.log("discoverer addPortal out of bounds")
             return;
         }
@@ -194,11 +210,12 @@ function wrapper(plugin_info) {
             return;
         }
 
-        if (!(doc.guid in window.plugin.portalDiscoverer.portalIndex)) {
+        var known_ref = _index_get(doc.guid);
+        if (known_ref === undefined) {
 //            console.log("discoverer checkInPortal new portal");
             window.plugin.portalDiscoverer.newPortals[doc.guid] = doc;
         }
-        else if (doc._ref != window.plugin.portalDiscoverer.portalIndex[doc.guid]) {
+        else if (doc._ref.substr(0, known_ref.length) != known_ref) {
 //            console.log("discoverer checkInPortal ref mismatch!", doc, window.plugin.portalDiscoverer.portalIndex[doc.guid])
             window.plugin.portalDiscoverer.newPortals[doc.guid] = doc;
         } else {
@@ -257,7 +274,7 @@ function wrapper(plugin_info) {
 
                     // var _ref = copiedNewPortals[guid]._ref
 //                    console.log("discoverer adding to index", guid, _ref)
-                    window.plugin.portalDiscoverer.portalIndex[guid] = portalsToSend[guid];
+                    window.plugin.portalDiscoverer.portalIndex[guid] = portalsToSend[guid]._ref;
                 }
 
 
@@ -269,8 +286,106 @@ function wrapper(plugin_info) {
 
     window.plugin.portalDiscoverer.fetchIndex = function() {
         if (window.plugin.portalDiscoverer.base_url) {
-            _xhr('GET', window.plugin.portalDiscoverer.base_url + "pidx", window.plugin.portalDiscoverer.handleKnownIndex);
+            var url = window.plugin.portalDiscoverer.base_url + "pidx";
+            if (window.plugin.portalDiscoverer.portalIndex && window.plugin.portalDiscoverer.portalIndexSeq !== undefined) {
+                url += "?since=" + window.plugin.portalDiscoverer.portalIndexSeq;
+            } else if (window.plugin.portalDiscoverer.use_tiled_index) {
+                window.plugin.portalDiscoverer.fetchTiles();
+                return;
+            } else if (window.plugin.portalDiscoverer.use_binary_index && window.ArrayBuffer) {
+                _xhr('GET', url + "?format=bin", window.plugin.portalDiscoverer.handleBinaryIndex, undefined, true, 'arraybuffer');
+                return;
+            }
+            _xhr('GET', url, window.plugin.portalDiscoverer.handleKnownIndex);
+        }
+    };
+
+    window.plugin.portalDiscoverer.fetchTiles = function() {
+        // only the tiles in view that we don't hold, the ones we hold are kept current by the ?since= deltas
+        if (!window.plugin.portalDiscoverer.base_url || !window.plugin.portalDiscoverer.use_tiled_index) {
+            return;
+        }
+        var now = Date.now();
+        var tiles = _viewport_tiles();
+        var missing = [];
+        for (var i = 0; i < tiles.length; i++) {
+            var requested = window.plugin.portalDiscoverer.tilesRequested[tiles[i]];
+            if (!(tiles[i] in window.plugin.portalDiscoverer.portalIndexTiles) && !(requested && now - requested < 60*1000)) {
+                missing.push(tiles[i]);
+                window.plugin.portalDiscoverer.tilesRequested[tiles[i]] = now;
+            }
+        }
+        if (missing.length > 0) {
+            _xhr('GET', window.plugin.portalDiscoverer.base_url + "pidx?tiles=" + missing.join(','),
+                window.plugin.portalDiscoverer.handleTiles);
+        }
+    };
+
+    window.plugin.portalDiscoverer.handleTiles = function(data) {
+        if (data.g !== undefined && data.g != window.plugin.portalDiscoverer.tile_degrees) {
+            // the server uses a different grid, start over on its tiles
+            window.plugin.portalDiscoverer.tile_degrees = data.g;
+            window.plugin.portalDiscoverer.portalIndexTiles = {};
+            window.plugin.portalDiscoverer.tilesRequested = {};
+            window.plugin.portalDiscoverer.fetchTiles();
+            return;
+        }
+        if (!window.plugin.portalDiscoverer.portalIndex) {
+            window.plugin.portalDiscoverer.portalIndex = {};
+        }
+        window.plugin.portalDiscoverer.filter_bounds = _search_regions(data);
+
+        // tiles are only rebuilt periodically, don't let an older tile undo changes we got from a delta
+        var seq = window.plugin.portalDiscoverer.portalIndexSeq;
+        var newer = seq === undefined || data.s >= seq;
+        for (var tile_id in data.t) {
+            if (!data.t.hasOwnProperty(tile_id)) continue;
+            var tile = data.t[tile_id];
+            window.plugin.portalDiscoverer.portalIndexTiles[tile_id] = tile.e;
+            delete window.plugin.portalDiscoverer.tilesRequested[tile_id];
+            for (var guid in tile.k) {
+                if (!tile.k.hasOwnProperty(guid)) continue;
+                if (newer || !(guid in window.plugin.portalDiscoverer.portalIndex)) {
+                    window.plugin.portalDiscoverer.portalIndex[guid] = tile.k[guid];
+                }
+            }
+        }
+        if (seq === undefined) {
+            // catch up on anything published since the tiles were built
+            window.plugin.portalDiscoverer.portalIndexSeq = data.s;
+            setTimeout(window.plugin.portalDiscoverer.fetchIndex, 0);
+        }
+
+        window.plugin.portalDiscoverer.processPortalQueue();
+    };
+
+    window.plugin.portalDiscoverer.handleBinaryIndex = function(buffer) {
+        // 16 byte header: "PIDX", version, key size, digest size, count, sequence number
+        var header = new DataView(buffer, 0, 16);
+        if (String.fromCharCode(header.getUint8(0), header.getUint8(1), header.getUint8(2), header.getUint8(3)) != "PIDX" ||
+            header.getUint8(4) != 1) {
+            window.plugin.portalDiscoverer.use_binary_index = false;
+            window.plugin.portalDiscoverer.fetchIndex();
+            return;
         }
+        var key_size = header.getUint8(5);
+        var digest_size = header.getUint16(6, true);
+        var count = header.getUint32(8, true);
+
+        window.plugin.portalDiscoverer.portalIndexBin = {
+            count: count,
+            key_size: key_size,
+            digest_size: digest_size,
+            keys: new Uint8Array(buffer, 16, count*key_size),
+            digests: new Uint8Array(buffer, 16 + count*key_size, count*digest_size)
+        };
+        window.plugin.portalDiscoverer.portalIndex = {};
+        window.plugin.portalDiscoverer.portalIndexSeq = header.getUint32(12, true);
+        window.plugin.portalDiscoverer.portalIndexComplete = true;
+
+        // regions and anything published since the snapshot come with the delta
+        window.plugin.portalDiscoverer.fetchIndex();
+        window.plugin.portalDiscoverer.processPortalQueue();
     };
 
     window.plugin.portalDiscoverer.handleKnownIndex = function(data) {
@@ -280,10 +395,23 @@ function wrapper(plugin_info) {
         var known;
         if (data.k) {
 //            console.log("discoverer new style index", data.r)
-            window.plugin.portalDiscoverer.filter_bounds = data.r;
+            window.plugin.portalDiscoverer.filter_bounds = _search_regions(data);
             known = data.k;
+            if (!data.d) {
+                window.plugin.portalDiscoverer.portalIndexBin = undefined;
+                window.plugin.portalDiscoverer.portalIndexComplete = true;
+            }
+            if (data.s !== undefined) {
+                var was_snapshot = !data.d && window.plugin.portalDiscoverer.portalIndexSeq === undefined;
+                window.plugin.portalDiscoverer.portalIndexSeq = data.s;
+                if (was_snapshot) {
+                    // snapshots are only rebuilt periodically, catch up on anything published since
+                    setTimeout(window.plugin.portalDiscoverer.fetchIndex, 0);
+                }
+            }
         } else {
             known = data;
+            window.plugin.portalDiscoverer.portalIndexComplete = true;
         }
         var n = Object.keys(known).length;
         for (var guid in known) {
@@ -297,29 +425,35 @@ function wrapper(plugin_info) {
     window.plugin.portalDiscoverer.processPortalQueue = function() {
         var i;
 
-        for (i = 0; i < window.plugin.portalDiscoverer.portalQueue.length; i++) {
-            window.plugin.portalDiscoverer.handlePortalAdded(window.plugin.portalDiscoverer.portalQueue[i]);
-        }
+        // portals whose tile hasn't arrived yet go back on the queues
+        var portalQueue = window.plugin.portalDiscoverer.portalQueue;
         window.plugin.portalDiscoverer.portalQueue = [];
-
-        for (i = 0; i < window.plugin.portalDiscoverer.highlightQueue.length; i++) {
-            window.plugin.portalDiscoverer.highlight(window.plugin.portalDiscoverer.highlightQueue[i]);
+        for (i = 0; i < portalQueue.length; i++) {
+            window.plugin.portalDiscoverer.handlePortalAdded(portalQueue[i]);
         }
+
+        var highlightQueue = window.plugin.portalDiscoverer.highlightQueue;
         window.plugin.portalDiscoverer.highlightQueue = [];
+        for (i = 0; i < highlightQueue.length; i++) {
+            window.plugin.portalDiscoverer.highlight(highlightQueue[i]);
+        }
     };
 
 
     // util functions
-    var _xhr = function(method, url, cb, data, async) {
+    var _xhr = function(method, url, cb, data, async, responseType) {
         if (async === undefined) async = true;
 
         var req = new window.XMLHttpRequest();
         req.withCredentials = true;
         req.open(method, url, async);
+        if (responseType) {
+            req.responseType = responseType;
+        }
         req.setRequestHeader("Content-Type", "application/json;charset=UTF-8");
         req.onreadystatechange = function() {
             if (req.readyState != 4) return;
-            if (req.status == 200) {
+            if (req.status >= 200 && req.status < 300) {
                 if (this.getResponseHeader('Content-Type') == "application/json") {
                     cb(JSON.parse(req.responseText));
                 } else {
@@ -332,6 +466,75 @@ function wrapper(plugin_info) {
         req.send(data);
 
     };
+    var _index_get = function(guid) {
+        // returns the known _ref for guid (only a prefix of it from the binary snapshot) or undefined
+        if (guid in window.plugin.portalDiscoverer.portalIndex) {
+            return window.plugin.portalDiscoverer.portalIndex[guid];
+        }
+        var bin = window.plugin.portalDiscoverer.portalIndexBin;
+        if (!bin || !/^[0-9a-f]{32}\./.test(guid)) {
+            return undefined;
+        }
+        var key = new Uint8Array(bin.key_size);
+        for (var k = 0; k < bin.key_size; k++) {
+            key[k] = parseInt(guid.substr(k*2, 2), 16);
+        }
+
+        var lo = 0, hi = bin.count - 1;
+        while (lo <= hi) {
+            var mid = (lo + hi) >>> 1;
+            var cmp = 0;
+            for (var i = 0; i < bin.key_size && cmp === 0; i++) {
+                cmp = bin.keys[mid*bin.key_size + i] - key[i];
+            }
+            if (cmp === 0) {
+                var ref = "";
+                for (var j = 0; j < bin.digest_size; j++) {
+                    var b = bin.digests[mid*bin.digest_size + j];
+                    ref += (b < 16 ? "0" : "") + b.toString(16);
+                }
+                return ref;
+            }
+            if (cmp < 0) {
+                lo = mid + 1;
+            } else {
+                hi = mid - 1;
+            }
+        }
+        return undefined;
+    };
+    var _index_size = function() {
+        var bin = window.plugin.portalDiscoverer.portalIndexBin;
+        return Object.keys(window.plugin.portalDiscoverer.portalIndex).length + (bin ? bin.count : 0);
+    };
+    var _tile_id = function(lat, lng) {
+        var g = window.plugin.portalDiscoverer.tile_degrees;
+        return Math.floor(lat/g) + "_" + Math.floor(lng/g);
+    };
+    var _tile_loaded = function(latlng) {
+        // without tiles the whole index is loaded at once
+        if (!window.plugin.portalDiscoverer.use_tiled_index || window.plugin.portalDiscoverer.portalIndexComplete) {
+            return true;
+        }
+        return _tile_id(latlng[0], latlng[1]) in window.plugin.portalDiscoverer.portalIndexTiles;
+    };
+    var _viewport_tiles = function() {
+        var g = window.plugin.portalDiscoverer.tile_degrees;
+        var bounds = window.map.getBounds();
+        var south = Math.floor(bounds.getSouth()/g), north = Math.floor(bounds.getNorth()/g);
+        var west = Math.floor(bounds.getWest()/g), east = Math.floor(bounds.getEast()/g);
+        var tiles = [];
+        if ((north - south + 1)*(east - west + 1) > window.plugin.portalDiscoverer.max_tiles_per_request) {
+            // zoomed too far out to be looking at portals
+            return tiles;
+        }
+        for (var lat = south; lat <= north; lat++) {
+            for (var lng = west; lng <= east; lng++) {
+                tiles.push(lat + "_" + lng);
+            }
+        }
+        return tiles;
+    };
     var _llstring = function(latlng) {
         return Number(latlng[0]).toFixed(6) + "," + Number(latlng[1]).toFixed(6);
     };
@@ -343,10 +546,29 @@ function wrapper(plugin_info) {
 
     var _rusha = new Rusha();
     var _portal_ref = function(doc) {
-        return _rusha.digest(doc.latE6+"|"+doc.lngE6+"|"+doc.name+"|"+doc.guid);
+        // rusha hashes a string's char codes as bytes, hand it the utf-8 encoding the server hashes
+        return _rusha.digest(unescape(encodeURIComponent(doc.latE6+"|"+doc.lngE6+"|"+doc.name+"|"+doc.guid)));
     };
 
 
+    var _search_regions = function(data) {
+        // servers before multiple search regions only send the one ring in r
+        if (data.rs) {
+            return data.rs;
+        }
+        return data.r ? [data.r] : undefined;
+    };
+    var _point_in_regions = function(point, regions) {
+        if (!regions || regions.length < 1) {
+            return true;
+        }
+        for (var i = 0; i < regions.length; i++) {
+            if (_point_in_polygon(point, regions[i])) {
+                return true;
+            }
+        }
+        return false;
+    };
     var _point_in_polygon = function (point, vs) {
         // https://github.com/substack/point-in-polygon
         // ray-casting algorithm based on